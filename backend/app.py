@@ -1,12 +1,18 @@
 import asyncio
+import heapq
 import json
 import os
 import html
+import re
+import sys
 import time
 import subprocess
+from bisect import bisect_left
+from collections import deque
+from operator import itemgetter
 from datetime import datetime, timezone
-from dataclasses import asdict
-from typing import Any, Dict, Optional, Set, List, Tuple
+from dataclasses import fields
+from typing import Any, Deque, Dict, Optional, Set, List, Tuple
 
 import httpx
 import paho.mqtt.client as mqtt
@@ -35,6 +41,7 @@ from decoder import (
   _normalize_lat_lon,
   _normalize_role,
   _rebuild_node_hash_map,
+  _remove_device_from_hash_map,
   _route_points_from_hashes,
   _route_points_from_device_ids,
   _safe_preview,
@@ -53,6 +60,7 @@ from history import (
 )
 from turnstile import TurnstileVerifier
 from los import (
+  _close_elevation_client,
   _fetch_elevations,
   _find_los_peaks,
   _find_los_suggestion,
@@ -92,9 +100,11 @@ from config import (
   ROUTE_HISTORY_COMPACT_INTERVAL,
   HISTORY_EDGE_SAMPLE_LIMIT,
   MESSAGE_ORIGIN_TTL_SECONDS,
+  MESSAGE_ORIGIN_MAX,
   HEAT_TTL_SECONDS,
   MQTT_ONLINE_SECONDS,
   MQTT_SEEN_BROADCAST_MIN_SECONDS,
+  UPDATE_QUEUE_MAX,
   MQTT_ONLINE_TOPIC_SUFFIXES,
   MQTT_ONLINE_FORCE_NAMES_SET,
   DEBUG_PAYLOAD,
@@ -147,6 +157,7 @@ from config import (
 )
 from state import (
   DeviceState,
+  MessageOrigin,
   stats,
   result_counts,
   seen_devices,
@@ -159,6 +170,9 @@ from state import (
   trails,
   routes,
   heat_events,
+  device_expiry_heap,
+  device_expiry_at,
+  route_expiry_heap,
   route_history_segments,
   route_history_edges,
   node_hash_to_device,
@@ -167,6 +181,7 @@ from state import (
   elevation_cache,
   device_names,
   message_origins,
+  message_origins_lock,
   device_roles,
   device_role_sources,
   neighbor_edges,
@@ -180,7 +195,10 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 
 mqtt_client: Optional[mqtt.Client] = None
 clients: Set[WebSocket] = set()
-update_queue: asyncio.Queue[Dict[str, Any]] = asyncio.Queue()
+# Plain deque plus a doorbell Event: appends are atomic (even from paho's
+# thread) and the broadcaster is woken once per burst rather than per item.
+update_queue: Deque[Dict[str, Any]] = deque()
+update_ready = asyncio.Event()
 git_update_info = {
   "available": False,
   "local": None,
@@ -190,6 +208,18 @@ git_update_info = {
   "error": None,
 }
 
+# Shared encoder for client-bound JSON: compact separators and no circular
+# reference bookkeeping (payloads are plain trees of dicts and lists).
+_json_encode = json.JSONEncoder(
+  check_circular=False, separators=(",", ":")
+).encode
+
+# (snapshot_version, UTF-8 snapshot fields without the outer braces, encoded
+# WS snapshot frame)
+_snapshot_cache: Tuple[int, bytes, bytes] = (-1, b"", b"")
+
+_heat_event_ts = itemgetter("ts")
+
 # Initialize Turnstile verifier if enabled
 turnstile_verifier: Optional[TurnstileVerifier] = None
 if TURNSTILE_ENABLED and TURNSTILE_SECRET_KEY:
@@ -325,33 +355,82 @@ def _prune_neighbors(now: float) -> None:
   if DEVICE_TTL_SECONDS <= 0 or not neighbor_edges:
     return
   cutoff = now - DEVICE_TTL_SECONDS
-  for src_id, edges in list(neighbor_edges.items()):
-    for dst_id, entry in list(edges.items()):
-      if entry.get("manual"):
-        continue
-      if entry.get("last_seen", 0.0) < cutoff:
-        edges.pop(dst_id, None)
+  # Only touched from the event loop, so scan in place and pop afterwards
+  # rather than copying every edge map.
+  empty_ids = []
+  for src_id, edges in neighbor_edges.items():
+    expired = [
+      dst_id for dst_id, entry in edges.items()
+      if not entry.get("manual") and entry.get("last_seen", 0.0) < cutoff
+    ]
+    for dst_id in expired:
+      edges.pop(dst_id, None)
     if not edges:
-      neighbor_edges.pop(src_id, None)
+      empty_ids.append(src_id)
+  for src_id in empty_ids:
+    neighbor_edges.pop(src_id, None)
 
 
-def _serialize_state() -> Dict[str, Any]:
+# Sections of the state file that are re-encoded only when marked dirty in
+# state.state_dirty; the others reuse their last encoded fragment.
+_STATE_SECTIONS = ("devices", "trails", "names")
+_state_fragments: Dict[str, str] = {}
+# Recorded in the state file; when it still matches on load, the saved trails
+# already passed the zero/radius filters and are not re-checked per point.
+_STATE_MAP_FILTER = [MAP_START_LAT, MAP_START_LON, MAP_RADIUS_KM]
+
+
+def _state_section(section: str) -> Dict[str, Any]:
+  if section == "devices":
+    return {
+      "devices":
+        {
+          k: {
+            name: getattr(v, name)
+            for name in _DEVICE_FIELDS
+          }
+          for k, v in devices.items()
+        },
+    }
+  if section == "trails":
+    return {"trails": {k: list(v) for k, v in trails.items()}}
   return {
-    "version": 1,
-    "saved_at": time.time(),
-    "devices": {
-      k: asdict(v)
-      for k, v in devices.items()
-    },
-    "trails": trails,
-    "seen_devices": seen_devices,
     "device_names": device_names,
     "device_roles": device_roles,
     "device_role_sources": device_role_sources,
   }
 
 
+def _serialize_state(dirty: Set[str]) -> List[str]:
+  for section in _STATE_SECTIONS:
+    if section in dirty or section not in _state_fragments:
+      # Fragment is the section's JSON object without its outer braces.
+      _state_fragments[section] = _json_encode(_state_section(section))[1:-1]
+  # seen_devices is touched by every MQTT status message without marking the
+  # state dirty, so it is always written fresh.
+  head = _json_encode(
+    {
+      "version": 1,
+      "saved_at": time.time(),
+      "map_filter": _STATE_MAP_FILTER,
+      "seen_devices": seen_devices,
+    }
+  )[:-1]
+  # Returned as pieces and written one after another, so the whole file is
+  # never joined into a second in-memory copy.
+  pieces = [head]
+  for section in _STATE_SECTIONS:
+    pieces.append(",")
+    pieces.append(_state_fragments[section])
+  pieces.append("}")
+  return pieces
+
+
+_git_safe_directory_added = False
+
+
 def _check_git_updates() -> None:
+  global _git_safe_directory_added
   if not GIT_CHECK_ENABLED:
     return
 
@@ -370,12 +449,17 @@ def _check_git_updates() -> None:
     return result.stdout.strip()
 
   try:
-    subprocess.run(
-      ["git", "config", "--global", "--add", "safe.directory", GIT_CHECK_PATH],
-      check=False,
-      stdout=subprocess.DEVNULL,
-      stderr=subprocess.DEVNULL,
-    )
+    # --add appends a new line every time, so register the path once.
+    if not _git_safe_directory_added:
+      subprocess.run(
+        [
+          "git", "config", "--global", "--add", "safe.directory", GIT_CHECK_PATH
+        ],
+        check=False,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+      )
+      _git_safe_directory_added = True
     inside = _run_git(
       ["git", "-C", GIT_CHECK_PATH, "rev-parse", "--is-inside-work-tree"]
     )
@@ -395,8 +479,10 @@ def _check_git_updates() -> None:
         stderr=subprocess.DEVNULL,
       )
 
-    local_sha = _run_git(["git", "-C", GIT_CHECK_PATH, "rev-parse", "HEAD"])
-    remote_sha = _run_git(["git", "-C", GIT_CHECK_PATH, "rev-parse", "@{u}"])
+    # One rev-parse resolves both refs instead of a process per ref.
+    local_sha, remote_sha = _run_git(
+      ["git", "-C", GIT_CHECK_PATH, "rev-parse", "HEAD", "@{u}"]
+    ).split()
     git_update_info["local"] = local_sha
     git_update_info["remote"] = remote_sha
     git_update_info["local_short"] = local_sha[:7]
@@ -417,11 +503,63 @@ async def _git_check_loop() -> None:
     return
   while True:
     await asyncio.sleep(GIT_CHECK_INTERVAL_SECONDS)
-    _check_git_updates()
+    # A fetch can take seconds; keep it off the event loop.
+    await asyncio.to_thread(_check_git_updates)
+    _mark_snapshot_dirty()
+
+
+def _mark_snapshot_dirty() -> None:
+  state.snapshot_version += 1
+
+
+def _snapshot_encoded() -> Tuple[bytes, bytes]:
+  """Serialized snapshot shared by /snapshot and the WS handshake.
+
+  Rebuilt only after the broadcaster, reaper or git check mark state dirty,
+  so bursts of new clients reuse one encoding. Returns the bare fields (for
+  /snapshot to extend) and the complete WS frame.
+  """
+  global _snapshot_cache
+  version = state.snapshot_version
+  if _snapshot_cache[0] == version:
+    return _snapshot_cache[1], _snapshot_cache[2]
+  device_json = ",".join(
+    _json_encode(k) + ":" + _device_payload_json(k, v)
+    for k, v in devices.items()
+  )
+  if len(_device_json_cache) > len(devices):
+    for device_id in [k for k in _device_json_cache if k not in devices]:
+      del _device_json_cache[device_id]
+  rest = _json_encode(
+    {
+      "trails": {
+        k: list(v)
+        for k, v in trails.items()
+      },
+      "routes": [_route_payload(r) for r in routes.values()],
+      "history_edges":
+        [_history_edge_payload(e) for e in route_history_edges.values()],
+      "history_window_seconds": int(max(0, ROUTE_HISTORY_HOURS * 3600)),
+      "heat": _serialize_heat_events(),
+      "update": git_update_info,
+    }
+  )
+  fields = ('"devices":{' + device_json + "}," + rest[1:-1]).encode("utf-8")
+  frame = b'{"type":"snapshot",' + fields + b"}"
+  _snapshot_cache = (version, fields, frame)
+  return fields, frame
+
+
+# DeviceState only holds scalars, so a flat field copy matches asdict() without
+# its recursive deep-copy walk (this runs for every device in a snapshot and
+# every state save). Derived init=False fields are left out.
+_DEVICE_FIELDS = tuple(
+  field.name for field in fields(DeviceState) if field.init
+)
 
 
 def _device_payload(device_id: str, state: "DeviceState") -> Dict[str, Any]:
-  payload = asdict(state)
+  payload = {name: getattr(state, name) for name in _DEVICE_FIELDS}
   last_seen = seen_devices.get(device_id)
   if last_seen:
     payload["last_seen_ts"] = last_seen
@@ -440,6 +578,65 @@ def _device_payload(device_id: str, state: "DeviceState") -> Dict[str, Any]:
   return payload
 
 
+# device_id -> (inputs, encoded _device_payload). Snapshots and update
+# broadcasts reuse the JSON until the DeviceState (compared field by field),
+# its in-place name/role edits or its seen timestamps change.
+_device_json_cache: Dict[str, Tuple[Tuple[Any, ...], str]] = {}
+
+
+def _device_payload_json(device_id: str, state: "DeviceState") -> str:
+  inputs = (
+    state,
+    state.name,
+    state.role,
+    seen_devices.get(device_id),
+    mqtt_seen.get(device_id),
+    device_names.get(device_id),
+  )
+  cached = _device_json_cache.get(device_id)
+  if cached is not None and cached[0] == inputs:
+    return cached[1]
+  encoded = _json_encode(_device_payload(device_id, state))
+  _device_json_cache[device_id] = (inputs, encoded)
+  return encoded
+
+
+# device_seen is the most frequent broadcast and has a fixed shape, so its
+# frame is filled from a template instead of building and encoding a dict.
+_DEVICE_SEEN_TEMPLATE = (
+  '{"type":"device_seen","device_id":%s,"last_seen_ts":%s,"mqtt_seen_ts":%s}'
+)
+
+
+def _device_seen_message(
+  device_id: str, seen_ts: float, mqtt_ts: Optional[float]
+) -> bytes:
+  return (
+    _DEVICE_SEEN_TEMPLATE %
+    (_json_encode(device_id), _json_encode(seen_ts), _json_encode(mqtt_ts))
+  ).encode("utf-8")
+
+
+def _device_update_message(device_id: str, state: "DeviceState") -> bytes:
+  return (
+    '{"type":"update","device":' + _device_payload_json(device_id, state) +
+    ',"trail":' + _json_encode(list(trails.get(device_id, ()))) + "}"
+  ).encode("utf-8")
+
+
+# Removal broadcasts are fixed keys around a single id list.
+_STALE_TEMPLATE = '{"type":"stale","device_ids":%s}'
+_ROUTE_REMOVE_TEMPLATE = '{"type":"route_remove","route_ids":%s}'
+
+
+def _stale_message(device_ids: List[str]) -> bytes:
+  return (_STALE_TEMPLATE % _json_encode(device_ids)).encode("utf-8")
+
+
+def _route_remove_message(route_ids: List[str]) -> bytes:
+  return (_ROUTE_REMOVE_TEMPLATE % _json_encode(route_ids)).encode("utf-8")
+
+
 def _iso_from_ts(ts: Optional[float]) -> Optional[str]:
   if ts is None:
     return None
@@ -450,6 +647,19 @@ def _iso_from_ts(ts: Optional[float]) -> Optional[str]:
     return None
 
 
+MAP_RADIUS_M = MAP_RADIUS_KM * 1000.0
+# The map centre is fixed, so its latitude terms are computed once and the
+# radius is compared against the haversine "a" term directly, skipping the
+# atan2/sqrt: d <= r  <=>  a <= sin^2(r / 2R) (clamped at the antipode).
+_MAP_CENTER_PHI = math.radians(MAP_START_LAT)
+_MAP_CENTER_COS = math.cos(_MAP_CENTER_PHI)
+_MAP_RADIUS_A_MAX = math.sin(
+  min(MAP_RADIUS_M / (2 * 6371000.0), math.pi / 2)
+)**2
+
+
+# Hot callers test MAP_RADIUS_KM > 0 themselves so the default (no radius)
+# skips the call entirely.
 def _within_map_radius(lat: Any, lon: Any) -> bool:
   if MAP_RADIUS_KM <= 0:
     return True
@@ -458,8 +668,11 @@ def _within_map_radius(lat: Any, lon: Any) -> bool:
     lon_val = float(lon)
   except (TypeError, ValueError):
     return False
-  distance_m = _haversine_m(MAP_START_LAT, MAP_START_LON, lat_val, lon_val)
-  return distance_m <= (MAP_RADIUS_KM * 1000.0)
+  phi = math.radians(lat_val)
+  sin_dlat = math.sin((phi - _MAP_CENTER_PHI) / 2)
+  sin_dlon = math.sin(math.radians(lon_val - MAP_START_LON) / 2)
+  a = sin_dlat**2 + _MAP_CENTER_COS * math.cos(phi) * sin_dlon**2
+  return a <= _MAP_RADIUS_A_MAX
 
 
 def _evict_device(device_id: str) -> bool:
@@ -471,12 +684,19 @@ def _evict_device(device_id: str) -> bool:
   seen_devices.pop(device_id, None)
   mqtt_seen.pop(device_id, None)
   last_seen_broadcast.pop(device_id, None)
+  device_expiry_at.pop(device_id, None)
   if removed:
-    state.state_dirty = True
-    _rebuild_node_hash_map()
+    state.state_dirty.update(("devices", "trails"))
+    _remove_device_from_hash_map(device_id)
   return removed
 
 
+def _ensure_node_hash_map() -> None:
+  if state.node_hash_map_dirty:
+    state.node_hash_map_dirty = False
+    _rebuild_node_hash_map()
+
+
 def _device_role_code(value: Any) -> int:
   if isinstance(value, int):
     if value in (1, 2, 3):
@@ -633,61 +853,98 @@ def _load_state() -> None:
   loaded_devices: Dict[str, DeviceState] = {}
   dropped_ids: Set[str] = set()
   for key, value in raw_devices.items():
-    if not isinstance(value, dict):
-      continue
     try:
-      state = DeviceState(**value)
+      # Non-dict entries fail the ** unpacking and are skipped here too.
+      device_state = DeviceState(**value)
     except Exception:
       continue
-    if _coords_are_zero(state.lat, state.lon
-                       ) or not _within_map_radius(state.lat, state.lon):
+    if not device_state.has_coords or (
+      MAP_RADIUS_KM > 0 and
+      not _within_map_radius(device_state.lat, device_state.lon)
+    ):
       dropped_ids.add(str(key))
       continue
-    loaded_devices[key] = state
+    loaded_devices[key] = device_state
 
   devices.clear()
   devices.update(loaded_devices)
+  device_expiry_at.clear()
+  device_expiry_at.update(
+    (dev_id, st.ts + DEVICE_TTL_SECONDS) for dev_id, st in devices.items()
+  )
+  device_expiry_heap[:] = [
+    (expires_at, dev_id) for dev_id, expires_at in device_expiry_at.items()
+  ]
+  heapq.heapify(device_expiry_heap)
   trails.clear()
   trails.update(data.get("trails") or {})
   seen_devices.clear()
   seen_devices.update(data.get("seen_devices") or {})
-  cleaned_trails: Dict[str, list] = {}
+  cleaned_trails: Dict[str, Deque[tuple]] = {}
   trails_dirty = False
-  for device_id, trail in trails.items():
-    if not isinstance(trail, list):
-      continue
-    filtered: list = []
-    for entry in trail:
-      if not isinstance(entry, (list, tuple)) or len(entry) < 2:
-        continue
-      lat = entry[0]
-      lon = entry[1]
-      try:
-        lat_val = float(lat)
-        lon_val = float(lon)
-      except (TypeError, ValueError):
+  # With trails disabled every loaded trail would be discarded below, so the
+  # per-point cleaning is skipped outright.
+  if TRAIL_LEN <= 0:
+    trails_dirty = bool(trails)
+    trails.clear()
+  trusted = None
+  same_filter = data.get("map_filter") == _STATE_MAP_FILTER
+  if trails and same_filter and data.get("version") == 1:
+    # Fast path for our own file under the same map filter: values are not
+    # re-checked, only the shape; anything unexpected falls back to the full
+    # cleaning.
+    trusted = {}
+    for device_id, trail in trails.items():
+      if not isinstance(trail, list) or not all(
+        isinstance(point, list) and len(point) >= 2 for point in trail
+      ):
+        trusted = None
+        break
+      if trail:
+        trusted[device_id] = deque(map(tuple, trail), maxlen=TRAIL_LEN)
+  if trusted is not None:
+    cleaned_trails = trusted
+    trails_dirty = len(trusted) != len(trails)
+  else:
+    check_radius = MAP_RADIUS_KM > 0
+    for device_id, trail in trails.items():
+      if not isinstance(trail, list):
         continue
-      if _coords_are_zero(lat_val,
-                          lon_val) or not _within_map_radius(lat_val, lon_val):
+      filtered: list = []
+      for entry in trail:
+        # Strings would index and float() fine, so the type is still checked;
+        # short or non-numeric points are rare and simply raise here.
+        if not isinstance(entry, (list, tuple)):
+          continue
+        try:
+          lat_val = float(entry[0])
+          lon_val = float(entry[1])
+        except (TypeError, ValueError, IndexError):
+          continue
+        # Values are already floats, so the zero test from _coords_are_zero is
+        # inlined rather than paying a call and two float() per point.
+        is_zero = abs(lat_val) < 1e-6 and abs(lon_val) < 1e-6
+        if is_zero or (
+          check_radius and not _within_map_radius(lat_val, lon_val)
+        ):
+          trails_dirty = True
+          continue
+        filtered.append(tuple(entry))
+      if filtered:
+        cleaned_trails[device_id] = deque(filtered, maxlen=TRAIL_LEN)
+      else:
         trails_dirty = True
-        continue
-      filtered.append(list(entry))
-    if filtered:
-      cleaned_trails[device_id] = filtered
-    else:
-      trails_dirty = True
   trails.clear()
   trails.update(cleaned_trails)
-  if TRAIL_LEN <= 0 and trails:
-    trails.clear()
-    trails_dirty = True
   if dropped_ids:
     for device_id in dropped_ids:
       trails.pop(device_id, None)
       seen_devices.pop(device_id, None)
       trails_dirty = True
   if trails_dirty:
-    state.state_dirty = True
+    state.state_dirty.add("trails")
+  if dropped_ids:
+    state.state_dirty.update(("devices", "names"))
   raw_names = data.get("device_names") or {}
   if isinstance(raw_names, dict):
     device_names.clear()
@@ -738,24 +995,33 @@ def _load_state() -> None:
       device_roles.pop(device_id, None)
   _rebuild_node_hash_map()
 
-  for device_id, state in devices.items():
-    if not state.name and device_id in device_names:
-      state.name = device_names[device_id]
+  for device_id, device_state in devices.items():
+    if not device_state.name and device_id in device_names:
+      device_state.name = device_names[device_id]
     role_value = device_roles.get(device_id)
-    state.role = role_value if role_value else None
+    device_state.role = role_value if role_value else None
+
+
+def _write_state_file(pieces: List[str]) -> None:
+  os.makedirs(STATE_DIR, exist_ok=True)
+  tmp_path = f"{STATE_FILE}.tmp"
+  with open(tmp_path, "w", encoding="utf-8") as handle:
+    handle.writelines(pieces)
+  os.replace(tmp_path, STATE_FILE)
 
 
 async def _state_saver() -> None:
   while True:
     if state.state_dirty:
+      dirty = set(state.state_dirty)
+      state.state_dirty.difference_update(dirty)
       try:
-        os.makedirs(STATE_DIR, exist_ok=True)
-        tmp_path = f"{STATE_FILE}.tmp"
-        with open(tmp_path, "w", encoding="utf-8") as handle:
-          json.dump(_serialize_state(), handle)
-        os.replace(tmp_path, STATE_FILE)
-        state.state_dirty = False
+        # Encoded on the loop so the file is a consistent snapshot (one-shot
+        # encode takes the C encoder); only the disk write runs in a thread.
+        pieces = _serialize_state(dirty)
+        await asyncio.to_thread(_write_state_file, pieces)
       except Exception as exc:
+        state.state_dirty.update(dirty)
         print(f"[state] failed to save {STATE_FILE}: {exc}")
     await asyncio.sleep(max(1.0, STATE_SAVE_INTERVAL))
 
@@ -775,24 +1041,64 @@ def mqtt_on_disconnect(
   print(f"[mqtt] disconnected reason_code={reason_code}")
 
 
+# Events produced on paho's network thread go straight onto update_queue; the
+# loop is woken at most once per burst, instead of once per event.
+_mqtt_wakeup_pending = False
+
+
+def _wake_broadcaster() -> None:
+  global _mqtt_wakeup_pending
+  # Clear the flag before ringing so an append racing with this wakeup either
+  # is already queued or schedules a fresh one.
+  _mqtt_wakeup_pending = False
+  update_ready.set()
+
+
+# Events that only nudge clients (state is already updated on this thread), so
+# they are shed first when the broadcaster falls behind.
+_SHEDDABLE_EVENT_TYPES = ("device_seen", "device_name", "device_role")
+_UPDATE_QUEUE_SOFT_MAX = max(1, UPDATE_QUEUE_MAX * 4 // 5)
+
+
+def _post_mqtt_event(
+  loop: asyncio.AbstractEventLoop, event: Dict[str, Any]
+) -> None:
+  global _mqtt_wakeup_pending
+  backlog = len(update_queue)
+  if backlog >= _UPDATE_QUEUE_SOFT_MAX and (
+    backlog >= UPDATE_QUEUE_MAX or event.get("type") in _SHEDDABLE_EVENT_TYPES
+  ):
+    stats["queue_dropped"] += 1
+    return
+  update_queue.append(event)
+  if not _mqtt_wakeup_pending:
+    _mqtt_wakeup_pending = True
+    loop.call_soon_threadsafe(_wake_broadcaster)
+
+
 def mqtt_on_message(client, userdata, msg: mqtt.MQTTMessage):
-  stats["received_total"] += 1
-  stats["last_rx_ts"] = time.time()
-  stats["last_rx_topic"] = msg.topic
-  topic_counts[msg.topic] = topic_counts.get(msg.topic, 0) + 1
+  # Read once; the topic and loop are used throughout this callback. Topics
+  # repeat per device, so interning makes the counter lookups identity hits.
+  topic = sys.intern(msg.topic)
   loop: asyncio.AbstractEventLoop = userdata["loop"]
+  # One timestamp per message keeps every field of its events consistent.
+  now = time.time()
+  stats["received_total"] += 1
+  stats["last_rx_ts"] = now
+  stats["last_rx_topic"] = topic
+  topic_counts[topic] = topic_counts.get(topic, 0) + 1
 
-  dev_guess = _device_id_from_topic(msg.topic)
-  if dev_guess and _topic_marks_online(msg.topic):
-    now = time.time()
+  # Parsed once; also the origin fallback and the receiver id below.
+  dev_guess = _device_id_from_topic(topic)
+  if dev_guess and _topic_marks_online(topic):
     seen_devices[dev_guess] = now
     mqtt_seen[dev_guess] = now
     if dev_guess in devices:
       last_sent = last_seen_broadcast.get(dev_guess, 0)
       if now - last_sent >= MQTT_SEEN_BROADCAST_MIN_SECONDS:
         last_seen_broadcast[dev_guess] = now
-        loop.call_soon_threadsafe(
-          update_queue.put_nowait,
+        _post_mqtt_event(
+          loop,
           {
             "type": "device_seen",
             "device_id": dev_guess,
@@ -801,26 +1107,32 @@ def mqtt_on_message(client, userdata, msg: mqtt.MQTTMessage):
           },
         )
 
-  parsed, debug = _try_parse_payload(msg.topic, msg.payload)
+  parsed, debug = _try_parse_payload(topic, msg.payload)
   device_id_hint = parsed.get("device_id") if parsed else None
-  if parsed and _coords_are_zero(parsed.get("lat", 0), parsed.get("lon", 0)):
+  if parsed:
+    parsed_lat = parsed.get("lat", 0)
+    parsed_lon = parsed.get("lon", 0)
+  if parsed and _coords_are_zero(parsed_lat, parsed_lon):
     debug["result"] = "filtered_zero_coords"
     parsed = None
-  if parsed and not _within_map_radius(parsed.get("lat"), parsed.get("lon")):
+  if (
+    parsed and MAP_RADIUS_KM > 0 and
+    not _within_map_radius(parsed_lat, parsed_lon)
+  ):
     debug["result"] = "filtered_radius"
     parsed = None
     if device_id_hint:
-      loop.call_soon_threadsafe(
-        update_queue.put_nowait,
+      _post_mqtt_event(
+        loop,
         {
           "type": "device_remove",
           "device_id": device_id_hint,
           "reason": "radius",
         },
       )
-  origin_id = debug.get("origin_id") or _device_id_from_topic(msg.topic)
+  origin_id = debug.get("origin_id") or dev_guess
   decoder_meta = debug.get("decoder_meta") or {}
-  result = debug.get("result") or "unknown"
+  result = sys.intern(debug.get("result") or "unknown")
   device_role = debug.get("device_role")
   role_target_id = origin_id
   if device_role and result.startswith("decoded"):
@@ -835,32 +1147,38 @@ def mqtt_on_message(client, userdata, msg: mqtt.MQTTMessage):
       decoded_pubkey = debug.get("decoded_pubkey")
       if isinstance(decoded_pubkey, str) and decoded_pubkey.strip():
         role_target_id = decoded_pubkey
-  debug_entry = {
-    "ts": time.time(),
-    "topic": msg.topic,
-    "result": debug.get("result"),
-    "found_path": debug.get("found_path"),
-    "found_hint": debug.get("found_hint"),
-    "decoder_meta": decoder_meta,
-    "role_target_id": role_target_id,
-    "packet_hash": debug.get("packet_hash"),
-    "direction": debug.get("direction"),
-    "json_keys": debug.get("json_keys"),
-    "parse_error": debug.get("parse_error"),
-    "origin_id": origin_id,
-    "payload_preview": _safe_preview(msg.payload[:DEBUG_PAYLOAD_MAX]),
-  }
-  debug_last.append(debug_entry)
-  if msg.topic.endswith("/status"):
+  # The per-message debug ring is only filled when DEBUG_PAYLOAD is on so
+  # prod does not build (and slice a preview for) an entry per message.
+  payload_preview = None
+  if DEBUG_PAYLOAD:
+    payload_preview = _safe_preview(msg.payload[:DEBUG_PAYLOAD_MAX])
+    debug_last.append(
+      {
+        "ts": now,
+        "topic": topic,
+        "result": debug.get("result"),
+        "found_path": debug.get("found_path"),
+        "found_hint": debug.get("found_hint"),
+        "decoder_meta": decoder_meta,
+        "role_target_id": role_target_id,
+        "packet_hash": debug.get("packet_hash"),
+        "direction": debug.get("direction"),
+        "json_keys": debug.get("json_keys"),
+        "parse_error": debug.get("parse_error"),
+        "origin_id": origin_id,
+        "payload_preview": payload_preview,
+      }
+    )
+  if topic.endswith("/status"):
     status_last.append(
       {
-        "ts": debug_entry["ts"],
-        "topic": msg.topic,
+        "ts": now,
+        "topic": topic,
         "device_name": debug.get("device_name"),
         "device_role": debug.get("device_role"),
         "origin_id": origin_id,
-        "json_keys": debug_entry.get("json_keys"),
-        "payload_preview": debug_entry["payload_preview"],
+        "json_keys": debug.get("json_keys"),
+        "payload_preview": payload_preview,
       }
     )
 
@@ -871,13 +1189,13 @@ def mqtt_on_message(client, userdata, msg: mqtt.MQTTMessage):
     existing_name = device_names.get(origin_id)
     if existing_name != device_name:
       device_names[origin_id] = device_name
-      state.state_dirty = True
+      state.state_dirty.add("names")
       device_state = devices.get(origin_id)
       if device_state:
         device_state.name = device_name
-        loop: asyncio.AbstractEventLoop = userdata["loop"]
-        loop.call_soon_threadsafe(
-          update_queue.put_nowait,
+        state.state_dirty.add("devices")
+        _post_mqtt_event(
+          loop,
           {
             "type": "device_name",
             "device_id": origin_id,
@@ -888,13 +1206,13 @@ def mqtt_on_message(client, userdata, msg: mqtt.MQTTMessage):
     if existing_role != device_role:
       device_roles[role_target_id] = device_role
       device_role_sources[role_target_id] = "explicit"
-      state.state_dirty = True
+      state.state_dirty.add("names")
       device_state = devices.get(role_target_id)
       if device_state:
         device_state.role = device_role
-        loop: asyncio.AbstractEventLoop = userdata["loop"]
-        loop.call_soon_threadsafe(
-          update_queue.put_nowait,
+        state.state_dirty.add("devices")
+        _post_mqtt_event(
+          loop,
           {
             "type": "device_role",
             "device_id": role_target_id,
@@ -908,7 +1226,7 @@ def mqtt_on_message(client, userdata, msg: mqtt.MQTTMessage):
   snr_values = decoder_meta.get("snrValues")
   path_header = decoder_meta.get("path")
   direction = debug.get("direction")
-  receiver_id = _device_id_from_topic(msg.topic)
+  receiver_id = dev_guess
   route_origin_id = None
   loc_meta = decoder_meta.get("location"
                              ) if isinstance(decoder_meta, dict) else None
@@ -916,26 +1234,28 @@ def mqtt_on_message(client, userdata, msg: mqtt.MQTTMessage):
     decoded_pubkey = loc_meta.get("pubkey")
     if decoded_pubkey:
       route_origin_id = decoded_pubkey
-  direction_value = str(direction or "").lower()
+  direction_value = sys.intern(str(direction or "").lower())
   if message_hash:
-    cache = message_origins.get(message_hash)
-    if not cache:
-      cache = {
-        "origin_id": None,
-        "first_rx": None,
-        "receivers": set(),
-        "ts": time.time(),
-      }
-      message_origins[message_hash] = cache
-    cache["ts"] = time.time()
+    with message_origins_lock:
+      cache = message_origins.get(message_hash)
+      if cache is None:
+        cache = MessageOrigin(ts=now)
+        message_origins[message_hash] = cache
+        if len(message_origins) > MESSAGE_ORIGIN_MAX:
+          message_origins.popitem(last=False)
+      else:
+        cache.ts = now
+        message_origins.move_to_end(message_hash)
     origin_for_tx = origin_id or receiver_id
     if direction_value == "tx" and origin_for_tx:
-      cache["origin_id"] = origin_for_tx
+      cache.origin_id = origin_for_tx
     if direction_value == "rx" and receiver_id:
-      cache["receivers"].add(receiver_id)
-      if not cache.get("first_rx"):
-        cache["first_rx"] = receiver_id
-  loop: asyncio.AbstractEventLoop = userdata["loop"]
+      if cache.receivers is None:
+        cache.receivers = {receiver_id}
+      else:
+        cache.receivers.add(receiver_id)
+      if not cache.first_rx:
+        cache.first_rx = receiver_id
   try:
     payload_type = int(payload_type) if payload_type is not None else None
   except (TypeError, ValueError):
@@ -954,8 +1274,8 @@ def mqtt_on_message(client, userdata, msg: mqtt.MQTTMessage):
 
   route_emitted = False
   if route_hashes and payload_type in ROUTE_PAYLOAD_TYPES_SET:
-    loop.call_soon_threadsafe(
-      update_queue.put_nowait,
+    _post_mqtt_event(
+      loop,
       {
         "type": "route",
         "path_hashes": route_hashes,
@@ -965,8 +1285,8 @@ def mqtt_on_message(client, userdata, msg: mqtt.MQTTMessage):
         "receiver_id": None,
         "snr_values": snr_values,
         "route_type": route_type,
-        "ts": time.time(),
-        "topic": msg.topic,
+        "ts": now,
+        "topic": topic,
       },
     )
     route_emitted = True
@@ -975,39 +1295,108 @@ def mqtt_on_message(client, userdata, msg: mqtt.MQTTMessage):
     stats["unparsed_total"] += 1
     if DEBUG_PAYLOAD:
       print(
-        f"[mqtt] UNPARSED result={result} topic={msg.topic} preview={debug_entry['payload_preview']!r}"
+        f"[mqtt] UNPARSED result={result} topic={topic} preview={payload_preview!r}"
       )
     return
 
-  parsed["raw_topic"] = msg.topic
+  parsed["raw_topic"] = topic
   stats["parsed_total"] += 1
-  stats["last_parsed_ts"] = time.time()
-  stats["last_parsed_topic"] = msg.topic
+  stats["last_parsed_ts"] = now
+  stats["last_parsed_topic"] = topic
 
   if DEBUG_PAYLOAD:
     print(
-      f"[mqtt] PARSED topic={msg.topic} device={parsed['device_id']} lat={parsed['lat']} lon={parsed['lon']}"
+      f"[mqtt] PARSED topic={topic} device={parsed['device_id']} lat={parsed['lat']} lon={parsed['lon']}"
     )
 
-  loop.call_soon_threadsafe(
-    update_queue.put_nowait, {
-      "type": "device",
-      "data": parsed
-    }
-  )
+  _post_mqtt_event(loop, {"type": "device", "data": parsed})
 
 
 # =========================
 # Broadcaster / Reaper
 # =========================
+def _ws_message(payload: Dict[str, Any]) -> bytes:
+  # Sent as a binary frame: the UTF-8 bytes are built once and every client
+  # gets the same object instead of re-encoding the text per socket.
+  return _json_encode(payload).encode("utf-8")
+
+
+async def _fanout(targets: Set[WebSocket], data: bytes) -> None:
+  # Encode once per broadcast and write to every client concurrently so one
+  # slow socket does not hold up the rest; failed clients are dropped.
+  conns = tuple(targets)
+  if not conns:
+    return
+  results = await asyncio.gather(
+    *(ws.send_bytes(data) for ws in conns), return_exceptions=True
+  )
+  dead = {
+    ws
+    for ws, result in zip(conns, results) if isinstance(result, Exception)
+  }
+  if dead:
+    targets.difference_update(dead)
+
+
+BROADCAST_BATCH_MAX = 256
+
+
+def _event_coalesce_key(event: Any) -> Optional[Tuple[str, Any]]:
+  # Events sharing a key within one batch only need their last broadcast:
+  # every "update" carries the full device and trail, and device_seen just
+  # overwrites timestamps.
+  if not isinstance(event, dict):
+    return None
+  kind = event.get("type")
+  if kind == "device_seen":
+    return ("seen", event.get("device_id"))
+  if kind in ("device_name", "device_role"):
+    return ("update", event.get("device_id"))
+  if kind == "device":
+    data = event.get("data")
+    return ("update", data.get("device_id")) if isinstance(data, dict) else None
+  if kind is None:
+    return ("update", event.get("device_id"))
+  return None
+
+
+async def _next_event_batch() -> List[Tuple[Any, bool]]:
+  """Wait for one event, drain whatever else is queued, flag superseded."""
+  while not update_queue:
+    await update_ready.wait()
+    update_ready.clear()
+  batch = [update_queue.popleft()]
+  while update_queue and len(batch) < BROADCAST_BATCH_MAX:
+    batch.append(update_queue.popleft())
+  latest: Dict[Tuple[str, Any], int] = {}
+  superseded = [False] * len(batch)
+  for idx, event in enumerate(batch):
+    key = _event_coalesce_key(event)
+    if key is None:
+      continue
+    prev = latest.get(key)
+    if prev is not None:
+      superseded[prev] = True
+    latest[key] = idx
+  return list(zip(batch, superseded))
+
+
 async def broadcaster():
+  pending: Deque[Tuple[Any, bool]] = deque()
   while True:
-    event = await update_queue.get()
+    if not pending:
+      _ensure_node_hash_map()
+      pending.extend(await _next_event_batch())
+    # Superseded events still update state in order (trails keep every
+    # point); only their broadcast is skipped in favour of the later one.
+    event, superseded = pending.popleft()
+    # Bumped per event: the fanout awaits below let /ws and /snapshot cache
+    # a snapshot mid-batch, before the remaining events are applied.
+    _mark_snapshot_dirty()
+    event_type = event.get("type") if isinstance(event, dict) else None
+    now = time.time()
 
-    if isinstance(event, dict) and event.get("type") in (
-      "device_name",
-      "device_role",
-    ):
+    if event_type in ("device_name", "device_role"):
       device_id = event.get("device_id")
       device_state = devices.get(device_id)
       if device_state:
@@ -1015,73 +1404,45 @@ async def broadcaster():
           device_state.name = device_names[device_id]
         if device_id in device_roles:
           device_state.role = device_roles[device_id]
-        payload = {
-          "type": "update",
-          "device": _device_payload(device_id, device_state),
-          "trail": trails.get(device_id, []),
-        }
-        dead = []
-        for ws in list(clients):
-          try:
-            await ws.send_text(json.dumps(payload))
-          except Exception:
-            dead.append(ws)
-        for ws in dead:
-          clients.discard(ws)
+        if superseded:
+          continue
+        await _fanout(clients, _device_update_message(device_id, device_state))
       continue
 
-    if isinstance(event, dict) and event.get("type") == "device_seen":
+    if event_type == "device_seen":
       device_id = event.get("device_id")
       device_state = devices.get(device_id)
-      if device_state:
-        seen_ts = event.get("last_seen_ts") or time.time()
+      if device_state and not superseded:
+        seen_ts = event.get("last_seen_ts") or now
         mqtt_ts = event.get("mqtt_seen_ts")
         seen_devices[device_id] = seen_ts
         if mqtt_ts:
           mqtt_seen[device_id] = mqtt_ts
-        payload = {
-          "type": "device_seen",
-          "device_id": device_id,
-          "last_seen_ts": seen_ts,
-          "mqtt_seen_ts": mqtt_ts,
-        }
-        dead = []
-        for ws in list(clients):
-          try:
-            await ws.send_text(json.dumps(payload))
-          except Exception:
-            dead.append(ws)
-        for ws in dead:
-          clients.discard(ws)
+        await _fanout(
+          clients, _device_seen_message(device_id, seen_ts, mqtt_ts)
+        )
       continue
 
-    if isinstance(event, dict) and event.get("type") == "device_remove":
+    if event_type == "device_remove":
       device_id = event.get("device_id")
       if device_id and _evict_device(device_id):
-        payload = {"type": "stale", "device_ids": [device_id]}
-        dead = []
-        for ws in list(clients):
-          try:
-            await ws.send_text(json.dumps(payload))
-          except Exception:
-            dead.append(ws)
-        for ws in dead:
-          clients.discard(ws)
+        await _fanout(clients, _stale_message([device_id]))
       continue
 
-    if isinstance(event, dict) and event.get("type") == "route":
+    if event_type == "route":
       route_mode = event.get("route_mode")
       points = event.get("points")
       used_hashes: List[str] = []
       point_ids: List[Optional[str]] = []
 
       if not points:
+        _ensure_node_hash_map()
         path_hashes = event.get("path_hashes") or []
         points, used_hashes, point_ids = _route_points_from_hashes(
           list(path_hashes),
           event.get("origin_id"),
           event.get("receiver_id"),
-          event.get("ts") or time.time(),
+          event.get("ts") or now,
         )
 
       if not points and route_mode == "fanout":
@@ -1117,19 +1478,26 @@ async def broadcaster():
         )
         if outside:
           continue
+      # Dropped here rather than broadcast and then swept by the reaper.
+      if any(
+        _coords_are_zero(point[0], point[1])
+        for point in points if isinstance(point, list) and len(point) >= 2
+      ):
+        continue
 
+      route_ts = event.get("ts") or now
       route_id = (
         event.get("route_id") or event.get("message_hash") or
-        f"{event.get('origin_id', 'route')}-{int(event.get('ts', time.time()) * 1000)}"
+        f"{event.get('origin_id', 'route')}-{int(event.get('ts', now) * 1000)}"
       )
-      expires_at = (event.get("ts") or time.time()) + ROUTE_TTL_SECONDS
+      expires_at = route_ts + ROUTE_TTL_SECONDS
       route = {
         "id": route_id,
         "points": points,
         "hashes": used_hashes,
         "point_ids": point_ids,
         "route_mode": route_mode or ("path" if used_hashes else "direct"),
-        "ts": event.get("ts") or time.time(),
+        "ts": route_ts,
         "expires_at": expires_at,
         "origin_id": event.get("origin_id"),
         "receiver_id": event.get("receiver_id"),
@@ -1140,6 +1508,7 @@ async def broadcaster():
       }
       _append_heat_points(points, route["ts"], event.get("payload_type"))
       routes[route_id] = route
+      heapq.heappush(route_expiry_heap, (expires_at, route_id))
 
       if point_ids and used_hashes:
         _record_neighbors(point_ids, route["ts"])
@@ -1147,14 +1516,7 @@ async def broadcaster():
       history_updates, history_removed = _record_route_history(route)
 
       payload = {"type": "route", "route": _route_payload(route)}
-      dead = []
-      for ws in list(clients):
-        try:
-          await ws.send_text(json.dumps(payload))
-        except Exception:
-          dead.append(ws)
-      for ws in dead:
-        clients.discard(ws)
+      await _fanout(clients, _ws_message(payload))
       if history_updates or history_removed:
         history_payload = {}
         if history_updates:
@@ -1169,43 +1531,28 @@ async def broadcaster():
           }
         else:
           history_payload_remove = None
-        dead = []
-        for ws in list(clients):
-          try:
-            if history_updates:
-              await ws.send_text(json.dumps(history_payload))
-            if history_payload_remove:
-              await ws.send_text(json.dumps(history_payload_remove))
-          except Exception:
-            dead.append(ws)
-        for ws in dead:
-          clients.discard(ws)
+        if history_updates:
+          await _fanout(clients, _ws_message(history_payload))
+        if history_payload_remove:
+          await _fanout(clients, _ws_message(history_payload_remove))
       continue
 
-    upd = (
-      event.get("data")
-      if isinstance(event, dict) and event.get("type") == "device" else event
-    )
+    upd = event.get("data") if event_type == "device" else event
 
     device_id = upd["device_id"]
-    if not _within_map_radius(upd.get("lat"), upd.get("lon")):
+    lat = upd.get("lat")
+    lon = upd.get("lon")
+    if MAP_RADIUS_KM > 0 and not _within_map_radius(lat, lon):
       if _evict_device(device_id):
-        payload = {"type": "stale", "device_ids": [device_id]}
-        dead = []
-        for ws in list(clients):
-          try:
-            await ws.send_text(json.dumps(payload))
-          except Exception:
-            dead.append(ws)
-        for ws in dead:
-          clients.discard(ws)
+        await _fanout(clients, _stale_message([device_id]))
       continue
-    is_new_device = device_id not in devices
+    previous = devices.get(device_id)
+    is_new_device = previous is None
     device_state = DeviceState(
       device_id=device_id,
-      lat=upd["lat"],
-      lon=upd["lon"],
-      ts=upd.get("ts", time.time()),
+      lat=lat,
+      lon=lon,
+      ts=upd.get("ts", now),
       heading=upd.get("heading"),
       speed=upd.get("speed"),
       rssi=upd.get("rssi"),
@@ -1215,41 +1562,41 @@ async def broadcaster():
       raw_topic=upd.get("raw_topic"),
     )
     devices[device_id] = device_state
-    seen_devices[device_id] = time.time()
-    state.state_dirty = True
+    seen_devices[device_id] = now
+    state.state_dirty.add("devices")
     if is_new_device:
-      _rebuild_node_hash_map()
-    if device_state.name:
+      state.node_hash_map_dirty = True
+    # The reaper re-pushes entries for devices that moved on, so a push is
+    # only needed when the new expiry is earlier than the scheduled one.
+    if DEVICE_TTL_SECONDS > 0:
+      expires_at = device_state.ts + DEVICE_TTL_SECONDS
+      scheduled = device_expiry_at.get(device_id)
+      if scheduled is None or expires_at < scheduled:
+        device_expiry_at[device_id] = expires_at
+        heapq.heappush(device_expiry_heap, (expires_at, device_id))
+    if device_state.name and device_names.get(device_id) != device_state.name:
       device_names[device_id] = device_state.name
-    if device_state.role:
+      state.state_dirty.add("names")
+    if device_state.role and device_roles.get(device_id) != device_state.role:
       device_roles[device_id] = device_state.role
-
-    if TRAIL_LEN > 0 and not _coords_are_zero(
-      device_state.lat, device_state.lon
-    ):
-      trails.setdefault(device_id, [])
-      trails[device_id].append(
-        [device_state.lat, device_state.lon, device_state.ts]
-      )
-      if len(trails[device_id]) > TRAIL_LEN:
-        trails[device_id] = trails[device_id][-TRAIL_LEN:]
+      state.state_dirty.add("names")
+
+    if TRAIL_LEN > 0 and not _coords_are_zero(lat, lon):
+      # maxlen makes the deque drop its oldest point in O(1) once full.
+      # Points are tuples (smaller than lists; they encode as the same JSON
+      # arrays).
+      trail = trails.get(device_id)
+      if trail is None:
+        trail = trails[device_id] = deque(maxlen=TRAIL_LEN)
+      trail.append((lat, lon, device_state.ts))
+      state.state_dirty.add("trails")
     elif device_id in trails:
       trails.pop(device_id, None)
+      state.state_dirty.add("trails")
 
-    payload = {
-      "type": "update",
-      "device": _device_payload(device_id, device_state),
-      "trail": trails.get(device_id, []),
-    }
-
-    dead = []
-    for ws in list(clients):
-      try:
-        await ws.send_text(json.dumps(payload))
-      except Exception:
-        dead.append(ws)
-    for ws in dead:
-      clients.discard(ws)
+    if superseded:
+      continue
+    await _fanout(clients, _device_update_message(device_id, device_state))
 
 
 async def reaper():
@@ -1257,114 +1604,89 @@ async def reaper():
     now = time.time()
 
     if DEVICE_TTL_SECONDS > 0:
-      stale = [
-        dev_id for dev_id, st in list(devices.items())
-        if now - st.ts > DEVICE_TTL_SECONDS
-      ]
-      if stale:
-        payload = {"type": "stale", "device_ids": stale}
-        dead = []
-        for ws in list(clients):
-          try:
-            await ws.send_text(json.dumps(payload))
-          except Exception:
-            dead.append(ws)
-        for ws in dead:
-          clients.discard(ws)
-
-        for dev_id in stale:
+      stale = []
+      while device_expiry_heap and device_expiry_heap[0][0] < now:
+        expires_at, dev_id = heapq.heappop(device_expiry_heap)
+        # Superseded by an earlier push for the same device.
+        if device_expiry_at.get(dev_id) != expires_at:
+          continue
+        st = devices.get(dev_id)
+        if st is None:
+          device_expiry_at.pop(dev_id, None)
+          continue
+        if now - st.ts > DEVICE_TTL_SECONDS:
+          stale.append(dev_id)
           devices.pop(dev_id, None)
           trails.pop(dev_id, None)
-          state.state_dirty = True
-        _rebuild_node_hash_map()
-
-    if routes:
-      bad_routes = []
-      for route_id, route in list(routes.items()):
-        points = route.get("points") if isinstance(route, dict) else None
-        if not isinstance(points, list):
-          continue
-        if any(
-          _coords_are_zero(p[0], p[1])
-          for p in points if isinstance(p, list) and len(p) >= 2
-        ):
-          bad_routes.append(route_id)
-      if bad_routes:
-        payload = {"type": "route_remove", "route_ids": bad_routes}
-        dead = []
-        for ws in list(clients):
-          try:
-            await ws.send_text(json.dumps(payload))
-          except Exception:
-            dead.append(ws)
-        for ws in dead:
-          clients.discard(ws)
-        for route_id in bad_routes:
-          routes.pop(route_id, None)
-
-    stale_routes = [
-      route_id for route_id, route in list(routes.items())
-      if now > route.get("expires_at", 0)
-    ]
-    if stale_routes:
-      payload = {"type": "route_remove", "route_ids": stale_routes}
-      dead = []
-      for ws in list(clients):
-        try:
-          await ws.send_text(json.dumps(payload))
-        except Exception:
-          dead.append(ws)
-      for ws in dead:
-        clients.discard(ws)
-      for route_id in stale_routes:
+          device_expiry_at.pop(dev_id, None)
+          _remove_device_from_hash_map(dev_id)
+        else:
+          # Not before now, so it is not popped again in this pass.
+          expires_at = st.ts + DEVICE_TTL_SECONDS
+          device_expiry_at[dev_id] = expires_at
+          heapq.heappush(device_expiry_heap, (expires_at, dev_id))
+      # Superseded entries otherwise linger until their stamp comes due;
+      # rebuild from the schedule once they dominate the heap.
+      if len(device_expiry_heap) > 2 * len(device_expiry_at) + 64:
+        device_expiry_heap[:] = [
+          (expires_at, dev_id)
+          for dev_id, expires_at in device_expiry_at.items()
+        ]
+        heapq.heapify(device_expiry_heap)
+      if stale:
+        await _fanout(clients, _stale_message(stale))
+        state.state_dirty.update(("devices", "trails"))
+
+    stale_routes = []
+    while route_expiry_heap and route_expiry_heap[0][0] < now:
+      _, route_id = heapq.heappop(route_expiry_heap)
+      route = routes.get(route_id)
+      if route is not None and now > route.get("expires_at", 0):
+        stale_routes.append(route_id)
         routes.pop(route_id, None)
+    if stale_routes:
+      await _fanout(clients, _route_remove_message(stale_routes))
 
     history_updates, history_removed = _prune_route_history()
-    if history_updates or history_removed:
-      dead = []
-      for ws in list(clients):
-        try:
-          if history_updates:
-            await ws.send_text(
-              json.dumps({
-                "type": "history_edges",
-                "edges": history_updates
-              })
-            )
-          if history_removed:
-            await ws.send_text(
-              json.dumps(
-                {
-                  "type": "history_edges_remove",
-                  "edge_ids": history_removed,
-                }
-              )
-            )
-        except Exception:
-          dead.append(ws)
-      for ws in dead:
-        clients.discard(ws)
+    if history_updates:
+      payload = {"type": "history_edges", "edges": history_updates}
+      await _fanout(clients, _ws_message(payload))
+    if history_removed:
+      payload = {"type": "history_edges_remove", "edge_ids": history_removed}
+      await _fanout(clients, _ws_message(payload))
 
     if HEAT_TTL_SECONDS > 0 and heat_events:
+      # Heat points are appended in arrival order, so the expired ones form
+      # a prefix that can be found by bisection and dropped in place.
       cutoff = now - HEAT_TTL_SECONDS
-      heat_events[:] = [
-        entry for entry in heat_events if entry.get("ts", 0) >= cutoff
-      ]
-
-    if message_origins:
-      for msg_hash, info in list(message_origins.items()):
-        if now - info.get("ts", 0) > MESSAGE_ORIGIN_TTL_SECONDS:
-          message_origins.pop(msg_hash, None)
+      del heat_events[:bisect_left(heat_events, cutoff, key=_heat_event_ts)]
+
+    # Touched entries move to the end, so the expired ones are at the front.
+    # The lock keeps paho's thread from reordering or refreshing them while
+    # the front is inspected and dropped.
+    with message_origins_lock:
+      while message_origins:
+        info = next(iter(message_origins.values()))
+        if now - info.ts <= MESSAGE_ORIGIN_TTL_SECONDS:
+          break
+        message_origins.popitem(last=False)
 
     _prune_neighbors(now)
 
     prune_after = (
       max(DEVICE_TTL_SECONDS * 3, 900) if DEVICE_TTL_SECONDS > 0 else 86400
     )
-    for dev_id, last in list(seen_devices.items()):
-      if now - last > prune_after:
-        seen_devices.pop(dev_id, None)
+    # seen_devices is also written from paho's thread, so the scan runs over
+    # an atomic dict copy (no per-item tuples) and the pops come after.
+    expired = [
+      dev_id for dev_id, last in seen_devices.copy().items()
+      if now - last > prune_after
+    ]
+    for dev_id in expired:
+      seen_devices.pop(dev_id, None)
 
+    # Also covers time-based expiry (heat, stale devices) in the snapshot.
+    _mark_snapshot_dirty()
     await asyncio.sleep(5)
 
 
@@ -1412,6 +1734,97 @@ def _check_turnstile_auth(request: Request) -> bool:
   return False
 
 
+# =========================
+# Helpers: index.html template
+# =========================
+TEMPLATE_VAR_RE = re.compile(r"\{\{(\w+)\}\}")
+
+# index.html with every process-lifetime placeholder already filled in; only
+# the per-request ones (OG tags, SITE_URL, UPDATE_*) are left for render time.
+_index_html_prebaked: Optional[str] = None
+
+
+def _index_static_replacements() -> Dict[str, Any]:
+  trail_info_suffix = ""
+  if TRAIL_LEN > 0:
+    trail_info_suffix = f" Trails show last ~{TRAIL_LEN} points."
+  return {
+    "SITE_TITLE": SITE_TITLE,
+    "SITE_DESCRIPTION": SITE_DESCRIPTION,
+    "SITE_ICON": SITE_ICON,
+    "SITE_FEED_NOTE": SITE_FEED_NOTE,
+    "CUSTOM_LINK_URL": CUSTOM_LINK_URL,
+    "ASSET_VERSION": ASSET_VERSION,
+    "DISTANCE_UNITS": DISTANCE_UNITS,
+    "NODE_MARKER_RADIUS": NODE_MARKER_RADIUS,
+    "HISTORY_LINK_SCALE": HISTORY_LINK_SCALE,
+    "TRAIL_INFO_SUFFIX": trail_info_suffix,
+    "PROD_MODE": str(PROD_MODE).lower(),
+    "PROD_TOKEN": PROD_TOKEN,
+    "MAP_START_LAT": MAP_START_LAT,
+    "MAP_START_LON": MAP_START_LON,
+    "MAP_START_ZOOM": MAP_START_ZOOM,
+    "MAP_RADIUS_KM": MAP_RADIUS_KM,
+    "MAP_RADIUS_SHOW": str(MAP_RADIUS_SHOW).lower(),
+    "MAP_DEFAULT_LAYER": MAP_DEFAULT_LAYER,
+    "LOS_ELEVATION_URL": LOS_ELEVATION_URL,
+    "LOS_SAMPLE_MIN": LOS_SAMPLE_MIN,
+    "LOS_SAMPLE_MAX": LOS_SAMPLE_MAX,
+    "LOS_SAMPLE_STEP_METERS": LOS_SAMPLE_STEP_METERS,
+    "LOS_PEAKS_MAX": LOS_PEAKS_MAX,
+    "MQTT_ONLINE_SECONDS": MQTT_ONLINE_SECONDS,
+    "COVERAGE_API_URL": COVERAGE_API_URL,
+    "TURNSTILE_ENABLED": str(TURNSTILE_ENABLED).lower(),
+    "TURNSTILE_SITE_KEY": TURNSTILE_SITE_KEY,
+  }
+
+
+def _fill_template(content: str, values: Dict[str, str]) -> str:
+  return TEMPLATE_VAR_RE.sub(
+    lambda match: values.get(match.group(1), match.group(0)), content
+  )
+
+
+def _render_index_html(
+  og_image_tag: str, twitter_image_tag: str, site_url: str
+) -> Optional[str]:
+  global _index_html_prebaked
+  if _index_html_prebaked is None:
+    html_path = os.path.join(APP_DIR, "static", "index.html")
+    try:
+      with open(html_path, "r", encoding="utf-8") as handle:
+        content = handle.read()
+    except Exception:
+      return None
+    _index_html_prebaked = _fill_template(
+      content,
+      {
+        key: html.escape(str(value), quote=True)
+        for key, value in _index_static_replacements().items()
+      },
+    )
+
+  dynamic = {
+    "SITE_URL":
+      site_url,
+    "UPDATE_AVAILABLE":
+      str(bool(git_update_info.get("available"))).lower(),
+    "UPDATE_LOCAL":
+      git_update_info.get("local_short") or "",
+    "UPDATE_REMOTE":
+      git_update_info.get("remote_short") or "",
+    "UPDATE_BANNER_HIDDEN":
+      "" if git_update_info.get("available") else "hidden",
+  }
+  values = {
+    key: html.escape(str(value), quote=True)
+    for key, value in dynamic.items()
+  }
+  values["OG_IMAGE_TAG"] = og_image_tag
+  values["TWITTER_IMAGE_TAG"] = twitter_image_tag
+  return _fill_template(_index_html_prebaked, values)
+
+
 # =========================
 # FastAPI routes
 # =========================
@@ -1440,14 +1853,6 @@ def root(request: Request):
 
     return HTMLResponse(content)
 
-  # Serve map page
-  html_path = os.path.join(APP_DIR, "static", "index.html")
-  try:
-    with open(html_path, "r", encoding="utf-8") as handle:
-      content = handle.read()
-  except Exception:
-    return FileResponse("static/index.html")
-
   # Check for lat/lon parameters for dynamic preview image
   query_params = request.query_params
   lat_param = query_params.get("lat") or query_params.get("latitude")
@@ -1528,86 +1933,12 @@ def root(request: Request):
     og_image_tag = f'<meta property="og:image" content="{safe_image}" />'
     twitter_image_tag = f'<meta name="twitter:image" content="{safe_image}" />'
 
-  content = content.replace("{{OG_IMAGE_TAG}}", og_image_tag)
-  content = content.replace("{{TWITTER_IMAGE_TAG}}", twitter_image_tag)
-
-  trail_info_suffix = ""
-  if TRAIL_LEN > 0:
-    trail_info_suffix = f" Trails show last ~{TRAIL_LEN} points."
-
   # Escape og_url for HTML
   SAFE_OG_URL = html.escape(str(og_url), quote=True)
 
-  replacements = {
-    "SITE_TITLE":
-      SITE_TITLE,
-    "SITE_DESCRIPTION":
-      SITE_DESCRIPTION,
-    "SITE_URL":
-      SAFE_OG_URL,
-    "SITE_ICON":
-      SITE_ICON,
-    "SITE_FEED_NOTE":
-      SITE_FEED_NOTE,
-    "CUSTOM_LINK_URL":
-      CUSTOM_LINK_URL,
-    "ASSET_VERSION":
-      ASSET_VERSION,
-    "DISTANCE_UNITS":
-      DISTANCE_UNITS,
-    "NODE_MARKER_RADIUS":
-      NODE_MARKER_RADIUS,
-    "HISTORY_LINK_SCALE":
-      HISTORY_LINK_SCALE,
-    "TRAIL_INFO_SUFFIX":
-      trail_info_suffix,
-    "PROD_MODE":
-      str(PROD_MODE).lower(),
-    "PROD_TOKEN":
-      PROD_TOKEN,
-    "MAP_START_LAT":
-      MAP_START_LAT,
-    "MAP_START_LON":
-      MAP_START_LON,
-    "MAP_START_ZOOM":
-      MAP_START_ZOOM,
-    "MAP_RADIUS_KM":
-      MAP_RADIUS_KM,
-    "MAP_RADIUS_SHOW":
-      str(MAP_RADIUS_SHOW).lower(),
-    "MAP_DEFAULT_LAYER":
-      MAP_DEFAULT_LAYER,
-    "LOS_ELEVATION_URL":
-      LOS_ELEVATION_URL,
-    "LOS_SAMPLE_MIN":
-      LOS_SAMPLE_MIN,
-    "LOS_SAMPLE_MAX":
-      LOS_SAMPLE_MAX,
-    "LOS_SAMPLE_STEP_METERS":
-      LOS_SAMPLE_STEP_METERS,
-    "LOS_PEAKS_MAX":
-      LOS_PEAKS_MAX,
-    "MQTT_ONLINE_SECONDS":
-      MQTT_ONLINE_SECONDS,
-    "COVERAGE_API_URL":
-      COVERAGE_API_URL,
-    "UPDATE_AVAILABLE":
-      str(bool(git_update_info.get("available"))).lower(),
-    "UPDATE_LOCAL":
-      git_update_info.get("local_short") or "",
-    "UPDATE_REMOTE":
-      git_update_info.get("remote_short") or "",
-    "UPDATE_BANNER_HIDDEN":
-       "" if git_update_info.get("available") else "hidden",
-    "TURNSTILE_ENABLED":
-       str(TURNSTILE_ENABLED).lower(),
-    "TURNSTILE_SITE_KEY":
-       TURNSTILE_SITE_KEY,
-  }
-  for key, value in replacements.items():
-    safe_value = html.escape(str(value), quote=True)
-    content = content.replace(f"{{{{{key}}}}}", safe_value)
-
+  content = _render_index_html(og_image_tag, twitter_image_tag, SAFE_OG_URL)
+  if content is None:
+    return FileResponse("static/index.html")
   return HTMLResponse(content)
 
 
@@ -1765,8 +2096,7 @@ async def preview_image(
           dev_lon = float(state.lon)
         except Exception:
           continue
-        if _coords_are_zero(dev_lat, dev_lon
-                           ) or not _within_map_radius(dev_lat, dev_lon):
+        if not state.has_coords or not _within_map_radius(dev_lat, dev_lon):
           continue
         dev_px_x, dev_px_y = latlon_to_global_px(dev_lat, dev_lon, zoom_val)
         img_x = width / 2 + (dev_px_x - center_px_x)
@@ -1921,69 +2251,18 @@ def map_page(request: Request):
     )
 
   # Otherwise serve the map page
-  html_path = os.path.join(APP_DIR, "static", "index.html")
-  try:
-    with open(html_path, "r", encoding="utf-8") as handle:
-      content = handle.read()
-  except Exception:
-    return FileResponse("static/index.html")
-
-  # Include all the template replacements (same as root endpoint)
-  # Generate OG image tags
   og_image_tag = ""
   twitter_image_tag = ""
   if SITE_OG_IMAGE:
     safe_image = html.escape(str(SITE_OG_IMAGE), quote=True)
     og_image_tag = f'<meta property="og:image" content="{safe_image}" />'
     twitter_image_tag = f'<meta name="twitter:image" content="{safe_image}" />'
-  
-  content = content.replace("{{OG_IMAGE_TAG}}", og_image_tag)
-  content = content.replace("{{TWITTER_IMAGE_TAG}}", twitter_image_tag)
-  
-  trail_info_suffix = ""
-  if TRAIL_LEN > 0:
-    trail_info_suffix = f" Trails show last ~{TRAIL_LEN} points."
 
   SAFE_OG_URL = html.escape(SITE_URL, quote=True)
 
-  replacements = {
-    "SITE_TITLE": SITE_TITLE,
-    "SITE_DESCRIPTION": SITE_DESCRIPTION,
-    "SITE_URL": SAFE_OG_URL,
-    "SITE_ICON": SITE_ICON,
-    "SITE_FEED_NOTE": SITE_FEED_NOTE,
-    "CUSTOM_LINK_URL": CUSTOM_LINK_URL,
-    "ASSET_VERSION": ASSET_VERSION,
-    "DISTANCE_UNITS": DISTANCE_UNITS,
-    "NODE_MARKER_RADIUS": NODE_MARKER_RADIUS,
-    "HISTORY_LINK_SCALE": HISTORY_LINK_SCALE,
-    "TRAIL_INFO_SUFFIX": trail_info_suffix,
-    "PROD_MODE": str(PROD_MODE).lower(),
-    "PROD_TOKEN": PROD_TOKEN,
-    "MAP_START_LAT": MAP_START_LAT,
-    "MAP_START_LON": MAP_START_LON,
-    "MAP_START_ZOOM": MAP_START_ZOOM,
-    "MAP_RADIUS_KM": MAP_RADIUS_KM,
-    "MAP_RADIUS_SHOW": str(MAP_RADIUS_SHOW).lower(),
-    "MAP_DEFAULT_LAYER": MAP_DEFAULT_LAYER,
-    "LOS_ELEVATION_URL": LOS_ELEVATION_URL,
-    "LOS_SAMPLE_MIN": LOS_SAMPLE_MIN,
-    "LOS_SAMPLE_MAX": LOS_SAMPLE_MAX,
-    "LOS_SAMPLE_STEP_METERS": LOS_SAMPLE_STEP_METERS,
-    "LOS_PEAKS_MAX": LOS_PEAKS_MAX,
-    "MQTT_ONLINE_SECONDS": MQTT_ONLINE_SECONDS,
-    "COVERAGE_API_URL": COVERAGE_API_URL,
-    "UPDATE_AVAILABLE": str(bool(git_update_info.get("available"))).lower(),
-    "UPDATE_LOCAL": git_update_info.get("local_short") or "",
-    "UPDATE_REMOTE": git_update_info.get("remote_short") or "",
-    "UPDATE_BANNER_HIDDEN": "" if git_update_info.get("available") else "hidden",
-    "TURNSTILE_ENABLED": str(TURNSTILE_ENABLED).lower(),
-    "TURNSTILE_SITE_KEY": TURNSTILE_SITE_KEY,
-  }
-  for key, value in replacements.items():
-    safe_value = html.escape(str(value), quote=True)
-    content = content.replace(f"{{{{{key}}}}}", safe_value)
-
+  content = _render_index_html(og_image_tag, twitter_image_tag, SAFE_OG_URL)
+  if content is None:
+    return FileResponse("static/index.html")
   return HTMLResponse(content)
 
 
@@ -2028,23 +2307,15 @@ def service_worker():
   return FileResponse("static/sw.js", media_type="application/javascript")
 
 
+# async so the cached snapshot is only built and read on the event loop, never
+# from the threadpool while the broadcaster is mutating state.
 @app.get("/snapshot")
-def snapshot(request: Request):
+async def snapshot(request: Request):
   _require_prod_token(request)
-  return {
-    "devices": {
-      k: _device_payload(k, v)
-      for k, v in devices.items()
-    },
-    "trails": trails,
-    "routes": [_route_payload(r) for r in routes.values()],
-    "history_edges":
-      [_history_edge_payload(e) for e in route_history_edges.values()],
-    "history_window_seconds": int(max(0, ROUTE_HISTORY_HOURS * 3600)),
-    "heat": _serialize_heat_events(),
-    "update": git_update_info,
-    "server_time": time.time(),
-  }
+  fields, _ = _snapshot_encoded()
+  server_time = _json_encode(time.time()).encode("ascii")
+  body = b"{" + fields + b',"server_time":' + server_time + b"}"
+  return Response(content=body, media_type="application/json")
 
 
 @app.get("/stats")
@@ -2158,7 +2429,7 @@ def get_peers(device_id: str, request: Request, limit: int = 8):
   limit_value = max(1, min(int(limit or 8), 50))
   payload = _peer_stats_for_device(device_id, limit_value)
   state = devices.get(device_id)
-  if state and not _coords_are_zero(state.lat, state.lon):
+  if state and state.has_coords:
     payload["lat"] = float(state.lat)
     payload["lon"] = float(state.lon)
   payload["name"] = (
@@ -2183,7 +2454,7 @@ def _peer_device_payload(
   if state:
     name = state.name or device_names.get(peer_id)
     role = state.role or device_roles.get(peer_id)
-    if not _coords_are_zero(state.lat, state.lon):
+    if state.has_coords:
       lat = float(state.lat)
       lon = float(state.lon)
   if not name:
@@ -2220,24 +2491,44 @@ def _peer_stats_for_device(device_id: str, limit: int) -> Dict[str, Any]:
   outbound: Dict[str, int] = {}
   inbound_last: Dict[str, float] = {}
   outbound_last: Dict[str, float] = {}
+  # Resolve exclusions once per call rather than once per matching segment.
+  excluded: Set[str] = set()
+  if MQTT_ONLINE_FORCE_NAMES_SET:
+    excluded = {
+      peer_id
+      for peer_id in devices.keys() | device_names.keys()
+      if _peer_is_excluded(peer_id)
+    }
+  # Segments are always built with a_id/b_id/ts keys (see history.py), so
+  # index directly and only fall back to counting on the first sighting.
   for entry in route_history_segments:
     if not isinstance(entry, dict):
       continue
-    a_id = entry.get("a_id")
-    b_id = entry.get("b_id")
-    if not a_id or not b_id:
+    a_id = entry["a_id"]
+    b_id = entry["b_id"]
+    if not a_id or not b_id or a_id == b_id:
       continue
-    ts = entry.get("ts") or 0
-    if a_id == device_id and b_id != device_id:
-      if _peer_is_excluded(b_id):
-        continue
-      outbound[b_id] = outbound.get(b_id, 0) + 1
-      outbound_last[b_id] = max(outbound_last.get(b_id, 0), float(ts))
-    if b_id == device_id and a_id != device_id:
-      if _peer_is_excluded(a_id):
-        continue
-      inbound[a_id] = inbound.get(a_id, 0) + 1
-      inbound_last[a_id] = max(inbound_last.get(a_id, 0), float(ts))
+    if a_id == device_id:
+      peer_id = b_id
+      counts = outbound
+      last = outbound_last
+    elif b_id == device_id:
+      peer_id = a_id
+      counts = inbound
+      last = inbound_last
+    else:
+      continue
+    if peer_id in excluded:
+      continue
+    ts = float(entry["ts"] or 0)
+    try:
+      counts[peer_id] += 1
+    except KeyError:
+      counts[peer_id] = 1
+      last[peer_id] = ts
+      continue
+    if ts > last[peer_id]:
+      last[peer_id] = ts
 
   inbound_total = sum(inbound.values())
   outbound_total = sum(outbound.values())
@@ -2270,7 +2561,7 @@ def _peer_stats_for_device(device_id: str, limit: int) -> Dict[str, Any]:
 
 
 @app.get("/los")
-def line_of_sight(
+async def line_of_sight(
   lat1: float,
   lon1: float,
   lat2: float,
@@ -2285,12 +2576,12 @@ def line_of_sight(
   if not start or not end:
     return {"ok": False, "error": "invalid_coords"}
 
-  points = _sample_los_points(start[0], start[1], end[0], end[1])
-  elevations, error = _fetch_elevations(points)
+  distance_m = _haversine_m(start[0], start[1], end[0], end[1])
+  samples = _sample_los_points(start[0], start[1], end[0], end[1], distance_m)
+  elevations, error = await _fetch_elevations(samples)
   if error:
     return {"ok": False, "error": error}
 
-  distance_m = _haversine_m(start[0], start[1], end[0], end[1])
   if distance_m <= 0:
     return {"ok": False, "error": "zero_distance"}
 
@@ -2301,22 +2592,24 @@ def line_of_sight(
   adjusted = list(elevations)
   adjusted[0] = start_elev
   adjusted[-1] = end_elev
-  max_obstruction = _los_max_obstruction(points, adjusted, 0, len(points) - 1)
+  count = len(samples.ts)
   max_terrain = max(elevations)
+  # Terrain entirely below both endpoints can never cut the straight line.
+  if max_terrain < min(start_elev, end_elev):
+    max_obstruction = 0.0
+  else:
+    max_obstruction = _los_max_obstruction(samples.ts, adjusted, 0, count - 1)
   blocked = max_obstruction > 0.0
-  suggestion = _find_los_suggestion(points, adjusted) if blocked else None
-  profile_samples = []
-  if distance_m > 0:
-    for (lat, lon, t), elev in zip(points, elevations):
-      line_elev = start_elev + (end_elev - start_elev) * t
-      profile_samples.append(
-        [
-          round(distance_m * t, 2),
-          round(float(elev), 2),
-          round(float(line_elev), 2),
-        ]
-      )
-  peaks = _find_los_peaks(points, elevations, distance_m)
+  suggestion = _find_los_suggestion(samples, adjusted) if blocked else None
+  # Elevations are already floats; build each row in one comprehension.
+  rise = end_elev - start_elev
+  profile_samples = [
+    [round(distance_m * t, 2),
+     round(elev, 2),
+     round(start_elev + rise * t, 2)]
+    for t, elev in zip(samples.ts, elevations)
+  ]
+  peaks = _find_los_peaks(samples, elevations, distance_m)
 
   response = {
     "ok": True,
@@ -2325,7 +2618,7 @@ def line_of_sight(
     "distance_m": round(distance_m, 2),
     "distance_km": round(distance_m / 1000.0, 3),
     "distance_mi": round(distance_m / 1609.344, 3),
-    "samples": len(points),
+    "samples": count,
     "elevation_m":
       {
         "start": round(start_elev, 2),
@@ -2339,12 +2632,10 @@ def line_of_sight(
     "peaks": peaks,
   }
   if include_points:
+    rows = zip(samples.lats, samples.lons, samples.ts, elevations)
     response["profile_points"] = [
-      [round(lat, 6),
-       round(lon, 6),
-       round(t, 4),
-       round(float(elev), 2)]
-      for (lat, lon, t), elev in zip(points, elevations)
+      [round(lat, 6), round(lon, 6),
+       round(t, 4), round(elev, 2)] for lat, lon, t, elev in rows
     ]
   return response
 
@@ -2364,7 +2655,9 @@ async def get_coverage():
       response = await client.get(url)
       response.raise_for_status()
       data = response.json()
-      # /get-samples returns { keys: [...] }, extract the keys array
+      # /get-samples returns { keys: [...] }, extract the keys array; a bare
+      # list is already the shape we serve, so its bytes pass straight through.
+      body = response.content if isinstance(data, list) else None
       samples = (
         data.get("keys", []) if isinstance(data, dict) else
         (data if isinstance(data, list) else [])
@@ -2376,7 +2669,9 @@ async def get_coverage():
         print(
           f"[coverage] Sample item keys: {list(samples[0].keys()) if samples[0] else 'N/A'}"
         )
-      return samples
+      if body is None:
+        body = _json_encode(samples).encode("utf-8")
+      return Response(content=body, media_type="application/json")
   except httpx.TimeoutException:
     raise HTTPException(status_code=504, detail="coverage_api_timeout")
   except httpx.HTTPStatusError as e:
@@ -2459,7 +2754,7 @@ async def verify_turnstile(request: Request):
       },
       status_code=200,
     )
-    
+
     # Set auth cookie (expires in TURNSTILE_TOKEN_TTL_SECONDS)
     response.set_cookie(
       key="meshmap_auth",
@@ -2468,7 +2763,7 @@ async def verify_turnstile(request: Request):
       path="/",
       samesite="lax",
     )
-    
+
     return response
 
   except json.JSONDecodeError:
@@ -2493,24 +2788,9 @@ async def ws_endpoint(ws: WebSocket):
   await ws.accept()
   clients.add(ws)
 
-  await ws.send_text(
-    json.dumps(
-      {
-        "type": "snapshot",
-        "devices": {
-          k: _device_payload(k, v)
-          for k, v in devices.items()
-        },
-        "trails": trails,
-        "routes": [_route_payload(r) for r in routes.values()],
-        "history_edges":
-          [_history_edge_payload(e) for e in route_history_edges.values()],
-        "history_window_seconds": int(max(0, ROUTE_HISTORY_HOURS * 3600)),
-        "heat": _serialize_heat_events(),
-        "update": git_update_info,
-      }
-    )
-  )
+  # Sent as a binary frame so the cached bytes go out without re-encoding.
+  _, frame = _snapshot_encoded()
+  await ws.send_bytes(frame)
 
   try:
     while True:
@@ -2530,13 +2810,16 @@ async def ws_endpoint(ws: WebSocket):
 async def startup():
   global mqtt_client
 
+  loop = asyncio.get_event_loop()
+  # Route history parsing only touches history state, so run it in a worker
+  # thread while the remaining (subprocess-heavy) startup steps proceed.
+  history_load = loop.run_in_executor(None, _load_route_history)
   _load_state()
-  _load_route_history()
   _load_neighbor_overrides()
   _ensure_node_decoder()
   _check_git_updates()
+  await history_load
 
-  loop = asyncio.get_event_loop()
   transport = "websockets" if MQTT_TRANSPORT == "websockets" else "tcp"
 
   topics_str = ", ".join(MQTT_TOPICS)
@@ -2590,3 +2873,6 @@ async def shutdown():
     except Exception:
       pass
     mqtt_client = None
+  await _close_elevation_client()
+  if turnstile_verifier is not None:
+    await turnstile_verifier.aclose()
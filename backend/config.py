@@ -57,11 +57,13 @@ ROUTE_HISTORY_COMPACT_INTERVAL = float(
 )
 HISTORY_EDGE_SAMPLE_LIMIT = 3
 MESSAGE_ORIGIN_TTL_SECONDS = int(os.getenv("MESSAGE_ORIGIN_TTL_SECONDS", "300"))
+MESSAGE_ORIGIN_MAX = int(os.getenv("MESSAGE_ORIGIN_MAX", "50000"))
 HEAT_TTL_SECONDS = int(os.getenv("HEAT_TTL_SECONDS", "600"))
 MQTT_ONLINE_SECONDS = int(os.getenv("MQTT_ONLINE_SECONDS", "300"))
 MQTT_SEEN_BROADCAST_MIN_SECONDS = float(
   os.getenv("MQTT_SEEN_BROADCAST_MIN_SECONDS", "5")
 )
+UPDATE_QUEUE_MAX = max(1, int(os.getenv("UPDATE_QUEUE_MAX", "10000")))
 MQTT_ONLINE_TOPIC_SUFFIXES = tuple(
   s.strip()
   for s in os.getenv("MQTT_ONLINE_TOPIC_SUFFIXES", "/status,/internal"
@@ -161,6 +163,14 @@ LOS_SAMPLE_MIN = int(os.getenv("LOS_SAMPLE_MIN", "10"))
 LOS_SAMPLE_MAX = int(os.getenv("LOS_SAMPLE_MAX", "80"))
 LOS_SAMPLE_STEP_METERS = int(os.getenv("LOS_SAMPLE_STEP_METERS", "250"))
 ELEVATION_CACHE_TTL = int(os.getenv("ELEVATION_CACHE_TTL", "21600"))
+# SQLite file backing the elevation cache across restarts (empty disables).
+ELEVATION_CACHE_FILE = os.getenv(
+  "ELEVATION_CACHE_FILE", os.path.join(STATE_DIR, "elevation_cache.sqlite")
+)
+# Entry caps for the in-memory and SQLite elevation tiers; the least recently
+# used entries are dropped past these.
+ELEVATION_CACHE_MAX = int(os.getenv("ELEVATION_CACHE_MAX", "50000"))
+ELEVATION_CACHE_DB_MAX = int(os.getenv("ELEVATION_CACHE_DB_MAX", "500000"))
 LOS_PEAKS_MAX = int(os.getenv("LOS_PEAKS_MAX", "4"))
 
 COVERAGE_API_URL = os.getenv("COVERAGE_API_URL", "").strip()
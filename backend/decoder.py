@@ -23,6 +23,7 @@ from config import (
   ROUTE_PAYLOAD_TYPES,
 )
 from state import (
+  _coords_are_zero,
   devices,
   heat_events,
   node_hash_candidates,
@@ -45,9 +46,16 @@ RE_LAT_LON = re.compile(
 # e.g. "42.3601 -71.0589" (two floats)
 RE_TWO_FLOATS = re.compile(r"(-?\d{1,2}\.\d+)\s*[,\s]+\s*(-?\d{1,3}\.\d+)")
 
+# Cheap single-pass prefilter: RE_LAT_LON needs "lat" and RE_TWO_FLOATS needs
+# a decimal number, so strings without either can skip both regexes.
+RE_LAT_LON_HINT = re.compile(r"lat|\d\.\d", re.IGNORECASE)
+
 BASE64_LIKE = re.compile(r"^[A-Za-z0-9+/]+={0,2}$")
 NODE_HASH_RE = re.compile(r"^[0-9a-fA-F]{2}$")
 
+# translate() deleting these leaves an empty result only for pure-hex input.
+HEX_DIGIT_BYTES = b"0123456789abcdefABCDEF"
+
 _node_ready_once = False
 _node_unavailable_once = False
 
@@ -105,15 +113,6 @@ def _normalize_lat_lon(lat: Any, lon: Any) -> Optional[Tuple[float, float]]:
   return None
 
 
-def _coords_are_zero(lat: Any, lon: Any) -> bool:
-  try:
-    lat_val = float(lat)
-    lon_val = float(lon)
-  except (TypeError, ValueError):
-    return False
-  return abs(lat_val) < 1e-6 and abs(lon_val) < 1e-6
-
-
 def _find_lat_lon_in_json(obj: Any) -> Optional[Tuple[float, float]]:
   """
     Recursively walk JSON objects/lists looking for lat/lon keys.
@@ -168,6 +167,9 @@ def _find_lat_lon_in_text(text: str) -> Optional[Tuple[float, float]]:
   """
     Try to extract coordinates from a text blob.
     """
+  if not RE_LAT_LON_HINT.search(text):
+    return None
+
   m = RE_LAT_LON.search(text)
   if m:
     normalized = _normalize_lat_lon(m.group(1), m.group(2))
@@ -205,7 +207,9 @@ def _looks_like_hex(s: str) -> bool:
     return False
   if len(s2) % 2 != 0:
     return False
-  return bool(re.fullmatch(r"[0-9a-fA-F]+", s2))
+  if not s2.isascii():
+    return False
+  return not s2.encode("ascii").translate(None, HEX_DIGIT_BYTES)
 
 
 def _try_base64_to_hex(s: str) -> Optional[str]:
@@ -286,6 +290,24 @@ def _rebuild_node_hash_map() -> None:
   node_hash_to_device.update(mapping)
 
 
+def _remove_device_from_hash_map(device_id: str) -> None:
+  # Incremental inverse of _rebuild_node_hash_map for one removed device.
+  node_hash = _node_hash_from_device_id(device_id)
+  if not node_hash:
+    return
+  ids = node_hash_candidates.get(node_hash)
+  if not ids or device_id not in ids:
+    return
+  ids.remove(device_id)
+  if not ids:
+    node_hash_candidates.pop(node_hash, None)
+    node_hash_to_device.pop(node_hash, None)
+    node_hash_collisions.discard(node_hash)
+  elif len(ids) == 1:
+    node_hash_collisions.discard(node_hash)
+    node_hash_to_device[node_hash] = ids[0]
+
+
 def _choose_closest_device(
   node_hash: str, ref_lat: float, ref_lon: float, ts: float
 ) -> Optional[str]:
@@ -642,15 +664,15 @@ def _append_heat_points(
 ) -> None:
   if HEAT_TTL_SECONDS <= 0:
     return
-  for point in points:
-    heat_events.append(
-      {
-        "lat": float(point[0]),
-        "lon": float(point[1]),
-        "ts": float(ts),
-        "weight": 0.7,
-      }
-    )
+  ts_val = float(ts)
+  heat_events.extend(
+    {
+      "lat": float(point[0]),
+      "lon": float(point[1]),
+      "ts": ts_val,
+      "weight": 0.7,
+    } for point in points
+  )
 
 
 def _serialize_heat_events() -> List[List[float]]:
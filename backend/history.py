@@ -1,8 +1,10 @@
 import asyncio
+import atexit
 import json
 import os
+import sys
 import time
-from typing import Any, Dict, List, Optional, Set, Tuple
+from typing import Any, BinaryIO, Dict, List, Optional, Set, Tuple
 
 import state
 from config import (
@@ -29,6 +31,26 @@ for _part in ROUTE_HISTORY_PAYLOAD_TYPES.split(","):
   except ValueError:
     pass
 
+_history_dir_ready = False
+_history_fh: Optional[BinaryIO] = None
+
+# Route history lines are positional JSON rows instead of keyed objects:
+# [ts, a_lat, a_lon, b_lat, b_lon, <_HISTORY_ROW_META fields...>].
+# Legacy object lines are still accepted on load.
+_HISTORY_ROW_META = (
+  "a_id",
+  "b_id",
+  "message_hash",
+  "payload_type",
+  "origin_id",
+  "receiver_id",
+  "route_mode",
+  "topic",
+)
+_HISTORY_ROW_LEN = 5 + len(_HISTORY_ROW_META)
+# Node ids repeat across most history entries; interning keeps one copy each.
+_HISTORY_ID_FIELDS = ("a_id", "b_id", "origin_id", "receiver_id")
+
 
 def _history_payload_allowed(payload_type: Optional[int]) -> bool:
   if not ROUTE_HISTORY_ENABLED or ROUTE_HISTORY_HOURS <= 0:
@@ -47,6 +69,10 @@ def _within_map_radius(lat: float, lon: float) -> bool:
   return distance_m <= (MAP_RADIUS_KM * 1000.0)
 
 
+def _intern_id(value: Any) -> Any:
+  return sys.intern(value) if isinstance(value, str) else value
+
+
 def _normalize_history_point(point: Any) -> Optional[Tuple[float, float]]:
   if not isinstance(point, (list, tuple)) or len(point) < 2:
     return None
@@ -62,14 +88,22 @@ def _normalize_history_point(point: Any) -> Optional[Tuple[float, float]]:
   return (round(lat_val, 6), round(lon_val, 6))
 
 
+HistoryEdgeKey = Tuple[Tuple[float, float], Tuple[float, float]]
+
+
 def _history_edge_key(
   a: Tuple[float, float], b: Tuple[float, float]
-) -> Tuple[str, Tuple[float, float], Tuple[float, float]]:
+) -> Tuple[HistoryEdgeKey, Tuple[float, float], Tuple[float, float]]:
+  # Points are already rounded, so the ordered pair itself is the dict key;
+  # the formatted id is only built once, when an edge is created.
   if a <= b:
-    key = f"{a[0]:.6f},{a[1]:.6f}|{b[0]:.6f},{b[1]:.6f}"
-    return key, a, b
-  key = f"{b[0]:.6f},{b[1]:.6f}|{a[0]:.6f},{a[1]:.6f}"
-  return key, b, a
+    return (a, b), a, b
+  return (b, a), b, a
+
+
+def _history_edge_id(key: HistoryEdgeKey) -> str:
+  a, b = key
+  return f"{a[0]:.6f},{a[1]:.6f}|{b[0]:.6f},{b[1]:.6f}"
 
 
 def _history_sample_from_route(route: Dict[str, Any],
@@ -93,11 +127,17 @@ def _update_history_edge_recent(
   recent = edge.get("recent")
   if not isinstance(recent, list):
     recent = []
-  recent.append(sample)
-  recent.sort(key=lambda s: s.get("ts", 0), reverse=True)
-  if len(recent) > HISTORY_EDGE_SAMPLE_LIMIT:
-    recent = recent[:HISTORY_EDGE_SAMPLE_LIMIT]
-  edge["recent"] = recent
+    edge["recent"] = recent
+  # recent stays sorted newest-first, so insert in place instead of
+  # re-sorting; live samples almost always land at index 0.
+  ts = sample.get("ts", 0)
+  idx = 0
+  while idx < len(recent) and recent[idx].get("ts", 0) >= ts:
+    idx += 1
+  if idx >= HISTORY_EDGE_SAMPLE_LIMIT:
+    return
+  recent.insert(idx, sample)
+  del recent[HISTORY_EDGE_SAMPLE_LIMIT:]
 
 
 def _record_route_history(
@@ -120,7 +160,9 @@ def _record_route_history(
 
   ts = route.get("ts") or time.time()
   sample = _history_sample_from_route(route, ts)
-  updated_keys: Set[str] = set()
+  origin_id = _intern_id(sample.get("origin_id"))
+  receiver_id = _intern_id(sample.get("receiver_id"))
+  updated_keys: Set[HistoryEdgeKey] = set()
   new_entries: List[Dict[str, Any]] = []
 
   for idx in range(len(points) - 1):
@@ -131,8 +173,8 @@ def _record_route_history(
     a_id = None
     b_id = None
     if point_ids and idx < len(point_ids) - 1:
-      a_id = point_ids[idx]
-      b_id = point_ids[idx + 1]
+      a_id = _intern_id(point_ids[idx])
+      b_id = _intern_id(point_ids[idx + 1])
     key, first, second = _history_edge_key(a, b)
     new_entries.append(
       {
@@ -143,8 +185,8 @@ def _record_route_history(
         "b_id": b_id,
         "message_hash": sample.get("message_hash"),
         "payload_type": sample.get("payload_type"),
-        "origin_id": sample.get("origin_id"),
-        "receiver_id": sample.get("receiver_id"),
+        "origin_id": origin_id,
+        "receiver_id": receiver_id,
         "route_mode": sample.get("route_mode"),
         "topic": sample.get("topic"),
       }
@@ -152,7 +194,7 @@ def _record_route_history(
     edge = state.route_history_edges.get(key)
     if not edge:
       edge = {
-        "id": key,
+        "id": _history_edge_id(key),
         "a": [first[0], first[1]],
         "b": [second[0], second[1]],
         "count": 0,
@@ -191,7 +233,7 @@ def _prune_route_history(
   if not ROUTE_HISTORY_ENABLED or not state.route_history_segments:
     return [], []
 
-  updated: Dict[str, Dict[str, Any]] = {}
+  updated: Dict[HistoryEdgeKey, Dict[str, Any]] = {}
   removed: List[str] = []
   now = time.time()
   cutoff = now - (ROUTE_HISTORY_HOURS * 3600)
@@ -214,8 +256,17 @@ def _prune_route_history(
     state.route_history_segments.popleft()
     a = entry.get("a")
     b = entry.get("b")
-    a_point = _normalize_history_point(a) if a else None
-    b_point = _normalize_history_point(b) if b else None
+    # Points were normalized when the entry was recorded or loaded, so the
+    # stored [lat, lon] pairs can be keyed directly.
+    if (
+      isinstance(a, list) and len(a) == 2 and isinstance(b, list) and
+      len(b) == 2
+    ):
+      a_point = (a[0], a[1])
+      b_point = (b[0], b[1])
+    else:
+      a_point = _normalize_history_point(a) if a else None
+      b_point = _normalize_history_point(b) if b else None
     if not a_point or not b_point:
       state.route_history_compact = True
       continue
@@ -232,7 +283,7 @@ def _prune_route_history(
         edge.pop("recent", None)
     if edge["count"] <= 0:
       state.route_history_edges.pop(key, None)
-      removed.append(key)
+      removed.append(edge.get("id") or _history_edge_id(key))
     else:
       updated[key] = edge
     state.route_history_compact = True
@@ -240,18 +291,78 @@ def _prune_route_history(
   return list(updated.values()), removed
 
 
+def _history_line(entry: Dict[str, Any]) -> str:
+  a = entry.get("a") or (None, None)
+  b = entry.get("b") or (None, None)
+  row = [entry.get("ts"), a[0], a[1], b[0], b[1]]
+  row.extend(entry.get(field) for field in _HISTORY_ROW_META)
+  return json.dumps(row, separators=(",", ":")) + "\n"
+
+
+def _history_entry_from_row(row: Any) -> Optional[Dict[str, Any]]:
+  if isinstance(row, dict):
+    entry = row
+  elif isinstance(row, list) and len(row) >= _HISTORY_ROW_LEN:
+    entry = {"ts": row[0], "a": [row[1], row[2]], "b": [row[3], row[4]]}
+    entry.update(zip(_HISTORY_ROW_META, row[5:]))
+  else:
+    return None
+  for field in _HISTORY_ID_FIELDS:
+    value = entry.get(field)
+    if isinstance(value, str):
+      entry[field] = sys.intern(value)
+  return entry
+
+
+def _history_handle() -> BinaryIO:
+  global _history_fh, _history_dir_ready
+  if _history_fh is None:
+    if not _history_dir_ready:
+      os.makedirs(os.path.dirname(ROUTE_HISTORY_FILE), exist_ok=True)
+      _history_dir_ready = True
+    _history_fh = open(ROUTE_HISTORY_FILE, "ab", buffering=0)
+  return _history_fh
+
+
+def _close_history_handle() -> None:
+  global _history_fh
+  if _history_fh is None:
+    return
+  try:
+    _history_fh.close()
+  except Exception:
+    pass
+  _history_fh = None
+
+
+atexit.register(_close_history_handle)
+
+
 def _append_route_history_file(entries: List[Dict[str, Any]]) -> None:
   if not ROUTE_HISTORY_ENABLED or not ROUTE_HISTORY_FILE:
     return
   if not entries:
     return
-  try:
-    os.makedirs(os.path.dirname(ROUTE_HISTORY_FILE), exist_ok=True)
-    with open(ROUTE_HISTORY_FILE, "a", encoding="utf-8") as handle:
-      for entry in entries:
-        handle.write(json.dumps(entry) + "\n")
-  except Exception as exc:
-    print(f"[history] failed to append {ROUTE_HISTORY_FILE}: {exc}")
+  global _history_dir_ready
+  buf = "".join(_history_line(entry) for entry in entries).encode("utf-8")
+  error: Optional[Exception] = None
+  # The handle is unbuffered, so write() may take only part of the buffer;
+  # loop until every byte is out. It stays open between batches; a failed
+  # write drops it and retries the rest once with a fresh open (e.g. after
+  # the file was removed).
+  view = memoryview(buf)
+  for _ in range(2):
+    try:
+      handle = _history_handle()
+      while view:
+        written = handle.write(view)
+        view = view[written:]
+      return
+    except Exception as exc:
+      error = exc
+      _close_history_handle()
+      _history_dir_ready = False
+  print(f"[history] failed to append {ROUTE_HISTORY_FILE}: {error}")
 
 
 def _load_route_history() -> None:
@@ -264,17 +375,21 @@ def _load_route_history() -> None:
   loaded_any = False
 
   try:
-    with open(ROUTE_HISTORY_FILE, "r", encoding="utf-8") as handle:
+    with open(ROUTE_HISTORY_FILE, "rb", buffering=1 << 16) as handle:
       for line in handle:
         line = line.strip()
         if not line:
           continue
         try:
-          entry = json.loads(line)
-        except json.JSONDecodeError:
+          raw = json.loads(line)
+        except (json.JSONDecodeError, UnicodeDecodeError):
           state.route_history_compact = True
           continue
-        if not isinstance(entry, dict):
+        if isinstance(raw, dict):
+          # Legacy keyed line: rewrite as rows on the next compaction.
+          state.route_history_compact = True
+        entry = _history_entry_from_row(raw)
+        if entry is None:
           state.route_history_compact = True
           continue
         ts = entry.get("ts")
@@ -314,7 +429,7 @@ def _load_route_history() -> None:
         edge = state.route_history_edges.get(key)
         if not edge:
           edge = {
-            "id": key,
+            "id": _history_edge_id(key),
             "a": [first[0], first[1]],
             "b": [second[0], second[1]],
             "count": 0,
@@ -352,12 +467,14 @@ async def _route_history_saver() -> None:
     try:
       os.makedirs(os.path.dirname(ROUTE_HISTORY_FILE), exist_ok=True)
       tmp_path = f"{ROUTE_HISTORY_FILE}.tmp"
-      with open(tmp_path, "w", encoding="utf-8") as handle:
-        for entry in state.route_history_segments:
-          if not isinstance(entry, dict):
-            continue
-          handle.write(json.dumps(entry) + "\n")
+      with open(tmp_path, "wb", buffering=1 << 16) as handle:
+        handle.writelines(
+          _history_line(entry).encode("utf-8")
+          for entry in state.route_history_segments if isinstance(entry, dict)
+        )
       os.replace(tmp_path, ROUTE_HISTORY_FILE)
+      # Reopen on the next append so writes land in the compacted file.
+      _close_history_handle()
       state.route_history_last_compact = now
       state.route_history_compact = False
     except Exception as exc:
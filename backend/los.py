@@ -1,11 +1,20 @@
-import json
+import asyncio
+import heapq
 import math
+import os
+import sqlite3
+import threading
 import time
-import urllib.parse
-import urllib.request
-from typing import Any, Dict, List, Optional, Tuple
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import httpx
 
 from config import (
+  ELEVATION_CACHE_DB_MAX,
+  ELEVATION_CACHE_FILE,
+  ELEVATION_CACHE_MAX,
   ELEVATION_CACHE_TTL,
   LOS_ELEVATION_URL,
   LOS_PEAKS_MAX,
@@ -16,6 +25,17 @@ from config import (
 from state import elevation_cache
 
 
+@dataclass
+class LosSamples:
+  """Sample positions along a LOS path, kept as parallel lists."""
+  lats: List[float]
+  lons: List[float]
+  ts: List[float]
+
+
+# Node positions and LOS endpoints repeat constantly, so both helpers are
+# memoized on their exact arguments.
+@lru_cache(maxsize=8192)
 def _haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
   radius = 6371000.0
   phi1 = math.radians(lat1)
@@ -28,117 +48,440 @@ def _haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
   return radius * c
 
 
+# SRTM90m is sampled every 3 arc-seconds; snapping keys to that grid lets
+# nearby samples share one cache entry and one provider lookup.
+SRTM_GRID_STEPS_PER_DEG = 1200
+
+
+@lru_cache(maxsize=8192)
 def _elevation_cache_key(lat: float, lon: float) -> str:
-  return f"{lat:.5f},{lon:.5f}"
+  lat_q = round(lat * SRTM_GRID_STEPS_PER_DEG) / SRTM_GRID_STEPS_PER_DEG
+  lon_q = round(lon * SRTM_GRID_STEPS_PER_DEG) / SRTM_GRID_STEPS_PER_DEG
+  return f"{lat_q:.5f},{lon_q:.5f}"
+
+
+def _chunked(seq: List[Any], size: int) -> Iterator[List[Any]]:
+  for i in range(0, len(seq), size):
+    yield seq[i:i + size]
+
+
+_elevation_client: Optional[httpx.AsyncClient] = None
+_elevation_db: Optional[sqlite3.Connection] = None
+_elevation_db_failed = False
+# The SQLite calls run in worker threads, so the shared connection is only
+# used under this lock.
+_elevation_db_lock = threading.Lock()
+# Row count of the SQLite table, kept in step with each store so the cap check
+# does not scan the table; None means it has to be counted again.
+_elevation_db_rows: Optional[int] = None
+# Grid keys currently being fetched; overlapping /los calls await these
+# instead of asking the provider for the same cells again.
+_elevation_inflight: Dict[str, "asyncio.Future[float]"] = {}
+
+
+def _get_elevation_client() -> httpx.AsyncClient:
+  # One pooled client for all LOS lookups so chunks and repeat requests reuse
+  # keep-alive connections instead of handshaking every time.
+  global _elevation_client
+  if _elevation_client is None:
+    _elevation_client = httpx.AsyncClient(
+      timeout=6.0,
+      limits=httpx.Limits(max_keepalive_connections=8),
+    )
+  return _elevation_client
+
+
+async def _close_elevation_client() -> None:
+  global _elevation_client
+  if _elevation_client is None:
+    return
+  try:
+    await _elevation_client.aclose()
+  except Exception:
+    pass
+  _elevation_client = None
+
+
+def _elevation_db_conn() -> Optional[sqlite3.Connection]:
+  # elevation_cache is the in-memory tier; this SQLite file persists fetched
+  # elevations so restarts do not re-query the provider.
+  global _elevation_db, _elevation_db_failed
+  if _elevation_db is not None or _elevation_db_failed:
+    return _elevation_db
+  if not ELEVATION_CACHE_FILE:
+    _elevation_db_failed = True
+    return None
+  try:
+    os.makedirs(os.path.dirname(ELEVATION_CACHE_FILE) or ".", exist_ok=True)
+    conn = sqlite3.connect(ELEVATION_CACHE_FILE, check_same_thread=False)
+    conn.execute(
+      "CREATE TABLE IF NOT EXISTS elevations ("
+      "key TEXT PRIMARY KEY, elevation REAL NOT NULL, fetched_at REAL NOT NULL)"
+    )
+    conn.execute(
+      "CREATE INDEX IF NOT EXISTS elevations_fetched_at "
+      "ON elevations (fetched_at)"
+    )
+    conn.execute(
+      "DELETE FROM elevations WHERE fetched_at < ?",
+      (time.time() - ELEVATION_CACHE_TTL, ),
+    )
+    conn.commit()
+  except Exception as exc:
+    print(f"[los] elevation cache disabled ({ELEVATION_CACHE_FILE}): {exc}")
+    _elevation_db_failed = True
+    return None
+  _elevation_db = conn
+  return conn
+
+
+# Both run via asyncio.to_thread so SQLite reads and commits stay off the
+# event loop.
+def _load_cached_elevations(keys: List[str],
+                            now: float) -> Dict[str, Tuple[float, float]]:
+  if not keys:
+    return {}
+  found: Dict[str, Tuple[float, float]] = {}
+  with _elevation_db_lock:
+    conn = _elevation_db_conn()
+    if conn is None:
+      return {}
+    try:
+      for chunk in _chunked(keys, 500):
+        placeholders = ",".join("?" * len(chunk))
+        rows = conn.execute(
+          "SELECT key, elevation, fetched_at FROM elevations "
+          f"WHERE key IN ({placeholders})",
+          chunk,
+        )
+        for key, elev, fetched_at in rows:
+          if now - fetched_at <= ELEVATION_CACHE_TTL:
+            found[key] = (float(elev), float(fetched_at))
+    except Exception as exc:
+      print(f"[los] elevation cache read failed: {exc}")
+  return found
+
+
+def _store_cached_elevations(
+  rows: List[Tuple[str, float, float]], now: float
+) -> None:
+  global _elevation_db_rows
+  if not rows:
+    return
+  with _elevation_db_lock:
+    conn = _elevation_db_conn()
+    if conn is None:
+      return
+    try:
+      if _elevation_db_rows is None:
+        cursor = conn.execute("SELECT COUNT(*) FROM elevations")
+        _elevation_db_rows = cursor.fetchone()[0]
+      # Keys already present are replaced rather than added; this is a
+      # primary-key lookup per key, not a table scan.
+      existing = 0
+      for chunk in _chunked([row[0] for row in rows], 500):
+        placeholders = ",".join("?" * len(chunk))
+        (found, ) = conn.execute(
+          f"SELECT COUNT(*) FROM elevations WHERE key IN ({placeholders})",
+          chunk,
+        ).fetchone()
+        existing += found
+      conn.executemany(
+        "INSERT OR REPLACE INTO elevations (key, elevation, fetched_at) "
+        "VALUES (?, ?, ?)",
+        rows,
+      )
+      count = _elevation_db_rows + len(rows) - existing
+      count -= conn.execute(
+        "DELETE FROM elevations WHERE fetched_at < ?",
+        (now - ELEVATION_CACHE_TTL, ),
+      ).rowcount
+      # Past the cap, the oldest fetches go first (they expire soonest).
+      if ELEVATION_CACHE_DB_MAX > 0 and count > ELEVATION_CACHE_DB_MAX:
+        count -= conn.execute(
+          "DELETE FROM elevations WHERE key IN ("
+          "SELECT key FROM elevations ORDER BY fetched_at LIMIT ?)",
+          (count - ELEVATION_CACHE_DB_MAX, ),
+        ).rowcount
+      conn.commit()
+      _elevation_db_rows = count
+    except Exception as exc:
+      print(f"[los] elevation cache write failed: {exc}")
+      _elevation_db_rows = None
+      try:
+        conn.rollback()
+      except Exception:
+        pass
+
+
+def _remember_elevation(key: str, cached: Tuple[float, float]) -> None:
+  elevation_cache[key] = cached
+  elevation_cache.move_to_end(key)
+  if ELEVATION_CACHE_MAX > 0:
+    while len(elevation_cache) > ELEVATION_CACHE_MAX:
+      elevation_cache.popitem(last=False)
 
 
-def _chunked(seq: List[Any], size: int) -> List[List[Any]]:
-  return [seq[i:i + size] for i in range(0, len(seq), size)]
+async def _fetch_elevation_chunk(client: httpx.AsyncClient,
+                                 chunk: List[str]) -> Dict[str, Any]:
+  # Cache keys are the snapped "lat,lon" pairs, so they double as locations.
+  locations = "|".join(chunk)
+  resp = await client.get(LOS_ELEVATION_URL, params={"locations": locations})
+  if resp.is_error:
+    return {"status": f"HTTP {resp.status_code}"}
+  return resp.json()
 
 
-def _fetch_elevations(
-  points: List[Tuple[float, float, float]]
+async def _fetch_elevations(
+  samples: LosSamples
 ) -> Tuple[Optional[List[float]], Optional[str]]:
   now = time.time()
-  results: List[Optional[float]] = [None] * len(points)
-  missing: List[Tuple[int, float, float, str]] = []
+  # NaN marks samples not filled yet; every stored value is already a float.
+  results: List[float] = [math.nan] * len(samples.ts)
+  # Grid key -> sample indices; adjacent samples often share a grid cell.
+  missing: Dict[str, List[int]] = {}
 
-  for idx, (lat, lon, _) in enumerate(points):
+  for idx, (lat, lon) in enumerate(zip(samples.lats, samples.lons)):
     key = _elevation_cache_key(lat, lon)
     cached = elevation_cache.get(key)
     if cached and now - cached[1] <= ELEVATION_CACHE_TTL:
+      elevation_cache.move_to_end(key)
       results[idx] = cached[0]
     else:
-      missing.append((idx, lat, lon, key))
+      missing.setdefault(key, []).append(idx)
 
-  if not missing:
-    if any(val is None for val in results):
-      return None, "elevation_fetch_failed: incomplete_cache"
-    return [float(val) for val in results], None
+  if missing:
+    stored = await asyncio.to_thread(
+      _load_cached_elevations, list(missing), now
+    )
+    for key, cached in stored.items():
+      _remember_elevation(key, cached)
+      for idx in missing.pop(key):
+        results[idx] = cached[0]
 
-  for chunk in _chunked(missing, 100):
-    locations = "|".join(f"{lat},{lon}" for _, lat, lon, _ in chunk)
-    query = urllib.parse.urlencode({"locations": locations})
-    url = f"{LOS_ELEVATION_URL}?{query}"
-    try:
-      with urllib.request.urlopen(url, timeout=6) as resp:
-        payload = json.loads(resp.read().decode("utf-8"))
-    except Exception as exc:
-      return None, f"elevation_fetch_failed: {exc}"
+  # Every index is either filled above or listed under a missing key; the
+  # fetch and wait below scatter values back by index, so one completeness
+  # check at the end covers every path.
+  to_fetch = [key for key in missing if key not in _elevation_inflight]
+  waiting = {
+    key: _elevation_inflight[key]
+    for key in missing if key in _elevation_inflight
+  }
+  loop = asyncio.get_running_loop()
+  owned = {key: loop.create_future() for key in to_fetch}
+  _elevation_inflight.update(owned)
+  error = None
+  fetched: List[Tuple[str, float, float]] = []
+  try:
+    if to_fetch:
+      error, fetched = await _fetch_missing_elevations(
+        to_fetch, missing, results, now
+      )
+  finally:
+    for key, fut in owned.items():
+      _elevation_inflight.pop(key, None)
+      if not fut.done():
+        fut.set_result(results[missing[key][0]])
+  if error:
+    return None, error
+  # Persisted only after the waiters above are released, so overlapping
+  # requests do not sit behind the SQLite write.
+  if fetched:
+    await asyncio.to_thread(_store_cached_elevations, fetched, now)
+
+  if waiting:
+    values = await asyncio.gather(
+      *(asyncio.shield(fut) for fut in waiting.values())
+    )
+    for key, value in zip(waiting, values):
+      if math.isnan(value):
+        return None, "elevation_fetch_failed: shared_fetch_failed"
+      for idx in missing[key]:
+        results[idx] = value
+
+  if any(map(math.isnan, results)):
+    return None, "elevation_fetch_failed: incomplete_results"
+  return results, None
+
+
+async def _fetch_missing_elevations(
+  keys: List[str],
+  missing: Dict[str, List[int]],
+  results: List[float],
+  now: float,
+) -> Tuple[Optional[str], List[Tuple[str, float, float]]]:
+  """Fill results from the provider; returns (error, rows to persist)."""
+  # Chunks are zipped against their payloads below, so keep them around.
+  chunks = list(_chunked(keys, 100))
+  client = _get_elevation_client()
+  payloads = await asyncio.gather(
+    *(_fetch_elevation_chunk(client, chunk) for chunk in chunks),
+    return_exceptions=True,
+  )
+
+  fetched: List[Tuple[str, float, float]] = []
+  for chunk, payload in zip(chunks, payloads):
+    if isinstance(payload, Exception):
+      return f"elevation_fetch_failed: {payload}", []
 
     if payload.get("status") not in (None, "OK"):
-      return None, f"elevation_fetch_failed: {payload.get('status')}"
+      return f"elevation_fetch_failed: {payload.get('status')}", []
 
     elev_results = payload.get("results", [])
     if len(elev_results) != len(chunk):
-      return None, "elevation_fetch_failed: unexpected_result_length"
+      return "elevation_fetch_failed: unexpected_result_length", []
 
-    for (idx, _, _, key), entry in zip(chunk, elev_results):
+    for key, entry in zip(chunk, elev_results):
       elev = entry.get("elevation")
       if elev is None:
-        return None, "elevation_fetch_failed: missing_elevation"
-      elevation_cache[key] = (float(elev), now)
-      results[idx] = float(elev)
+        return "elevation_fetch_failed: missing_elevation", []
+      value = float(elev)
+      _remember_elevation(key, (value, now))
+      for idx in missing[key]:
+        results[idx] = value
+      fetched.append((key, value, now))
 
-  if any(val is None for val in results):
-    return None, "elevation_fetch_failed: incomplete_results"
-  return [float(val) for val in results], None
+  return None, fetched
 
 
-def _sample_los_points(lat1: float, lon1: float, lat2: float,
-                       lon2: float) -> List[Tuple[float, float, float]]:
-  distance_m = _haversine_m(lat1, lon1, lat2, lon2)
+def _sample_los_points(
+  lat1: float,
+  lon1: float,
+  lat2: float,
+  lon2: float,
+  distance_m: Optional[float] = None,
+) -> LosSamples:
+  if distance_m is None:
+    distance_m = _haversine_m(lat1, lon1, lat2, lon2)
   if distance_m <= 0:
-    return [(lat1, lon1, 0.0), (lat2, lon2, 1.0)]
+    return LosSamples([lat1, lat2], [lon1, lon2], [0.0, 1.0])
 
   samples = int(distance_m / max(1.0, LOS_SAMPLE_STEP_METERS)) + 1
   samples = max(LOS_SAMPLE_MIN, min(LOS_SAMPLE_MAX, samples))
   if samples < 2:
     samples = 2
 
-  points: List[Tuple[float, float, float]] = []
-  for i in range(samples):
-    t = i / (samples - 1)
-    lat = lat1 + (lat2 - lat1) * t
-    lon = lon1 + (lon2 - lon1) * t
-    points.append((lat, lon, t))
-  return points
+  # Hoist the deltas so each sample is just a couple of multiply-adds.
+  last = samples - 1
+  dlat = lat2 - lat1
+  dlon = lon2 - lon1
+  ts = [i / last for i in range(samples)]
+  return LosSamples(
+    [lat1 + dlat * t for t in ts],
+    [lon1 + dlon * t for t in ts],
+    ts,
+  )
 
 
 def _los_max_obstruction(
-  points: List[Tuple[float, float, float]], elevations: List[float],
-  start_idx: int, end_idx: int
+  ts: List[float], elevations: List[float], start_idx: int, end_idx: int
 ) -> float:
   if end_idx <= start_idx + 1:
     return 0.0
-  start_t = points[start_idx][2]
-  end_t = points[end_idx][2]
+  start_t = ts[start_idx]
+  end_t = ts[end_idx]
   if end_t <= start_t:
     return 0.0
   start_elev = elevations[start_idx]
-  end_elev = elevations[end_idx]
+  span = end_t - start_t
+  rise = elevations[end_idx] - start_elev
   max_obstruction = 0.0
-  for idx in range(start_idx + 1, end_idx):
-    frac = (points[idx][2] - start_t) / (end_t - start_t)
-    line_elev = start_elev + (end_elev - start_elev) * frac
-    clearance = elevations[idx] - line_elev
+  # Loop-invariant terms are hoisted and the interior samples zipped, so the
+  # body is pure float arithmetic with no per-sample indexing.
+  for t, elev in zip(
+    ts[start_idx + 1:end_idx], elevations[start_idx + 1:end_idx]
+  ):
+    clearance = elev - (start_elev + rise * ((t - start_t) / span))
     if clearance > max_obstruction:
       max_obstruction = clearance
   return max_obstruction
 
 
-def _find_los_suggestion(
-  points: List[Tuple[float, float, float]], elevations: List[float]
-) -> Optional[Dict[str, Any]]:
-  if len(points) < 3:
+def _los_hull_add(
+  hull: List[Tuple[float, float, int]], slope: float, intercept: float, idx: int
+) -> None:
+  # Lines arrive with decreasing slopes; drop tail lines that can no longer
+  # reach the upper envelope.
+  while len(hull) >= 2:
+    m1, c1, _ = hull[-2]
+    m2, c2, _ = hull[-1]
+    if (intercept - c1) * (m1 - m2) >= (c2 - c1) * (m1 - slope):
+      hull.pop()
+    else:
+      break
+  hull.append((slope, intercept, idx))
+
+
+def _los_hull_best(hull: List[Tuple[float, float, int]], x: float) -> int:
+  lo = 0
+  hi = len(hull) - 1
+  while lo < hi:
+    mid = (lo + hi) // 2
+    here = hull[mid][1] + hull[mid][0] * x
+    if here <= hull[mid + 1][1] + hull[mid + 1][0] * x:
+      lo = mid + 1
+    else:
+      hi = mid
+  return hull[lo][2]
+
+
+def _los_pivot_obstructions(ts: List[float],
+                            elevations: List[float]) -> List[float]:
+  """Max obstruction of the best split at every interior pivot.
+
+  The clearance of sample j under the chord from an endpoint to pivot i is
+  linear in the chord slope, so each side is one sweep over an upper
+  envelope of lines instead of a rescan per pivot. The winning sample is
+  then re-evaluated with the same formula as _los_max_obstruction.
+  """
+  last = len(ts) - 1
+  t0 = ts[0]
+  e0 = elevations[0]
+  t_end = ts[last]
+  e_end = elevations[last]
+  scores = [0.0] * (last + 1)
+
+  hull: List[Tuple[float, float, int]] = []
+  for idx in range(1, last):
+    if idx > 1:
+      j = idx - 1
+      _los_hull_add(hull, -(ts[j] - t0), elevations[j] - e0, j)
+      t_i = ts[idx]
+      if t_i > t0:
+        j = _los_hull_best(hull, (elevations[idx] - e0) / (t_i - t0))
+        frac = (ts[j] - t0) / (t_i - t0)
+        clearance = elevations[j] - (e0 + (elevations[idx] - e0) * frac)
+        if clearance > 0.0:
+          scores[idx] = clearance
+
+  hull = []
+  for idx in range(last - 1, 0, -1):
+    if idx < last - 1:
+      j = idx + 1
+      _los_hull_add(hull, -(t_end - ts[j]), elevations[j] - e_end, j)
+      t_i = ts[idx]
+      if t_end > t_i:
+        j = _los_hull_best(hull, (elevations[idx] - e_end) / (t_end - t_i))
+        frac = (ts[j] - t_i) / (t_end - t_i)
+        clearance = elevations[j] - (
+          elevations[idx] + (e_end - elevations[idx]) * frac
+        )
+        if clearance > scores[idx]:
+          scores[idx] = clearance
+  return scores
+
+
+def _find_los_suggestion(samples: LosSamples,
+                         elevations: List[float]) -> Optional[Dict[str, Any]]:
+  count = len(samples.ts)
+  if count < 3:
     return None
+  scores = _los_pivot_obstructions(samples.ts, elevations)
   best_idx = None
   best_score = None
   best_clear = False
-  for idx in range(1, len(points) - 1):
-    obst_a = _los_max_obstruction(points, elevations, 0, idx)
-    obst_b = _los_max_obstruction(points, elevations, idx, len(points) - 1)
-    score = max(obst_a, obst_b)
+  for idx in range(1, count - 1):
+    score = scores[idx]
     clear = score <= 0.0
     if clear and not best_clear:
       best_idx = idx
@@ -156,9 +499,9 @@ def _find_los_suggestion(
     return None
   return {
     "lat":
-      round(points[best_idx][0], 6),
+      round(samples.lats[best_idx], 6),
     "lon":
-      round(points[best_idx][1], 6),
+      round(samples.lons[best_idx], 6),
     "elevation_m":
       round(float(elevations[best_idx]), 2),
     "clear":
@@ -169,18 +512,18 @@ def _find_los_suggestion(
 
 
 def _find_los_peaks(
-  points: List[Tuple[float, float, float]],
+  samples: LosSamples,
   elevations: List[float],
   distance_m: float,
 ) -> List[Dict[str, Any]]:
-  if len(points) < 3:
+  if len(samples.ts) < 3:
     return []
 
-  peak_indices = []
-  for idx in range(1, len(elevations) - 1):
-    elev = elevations[idx]
-    if elev >= elevations[idx - 1] and elev >= elevations[idx + 1]:
-      peak_indices.append(idx)
+  peak_indices = [
+    idx for idx, (prev, elev, nxt) in
+    enumerate(zip(elevations, elevations[1:], elevations[2:]), start=1)
+    if elev >= prev and elev >= nxt
+  ]
 
   if not peak_indices:
     try:
@@ -191,19 +534,21 @@ def _find_los_peaks(
     except ValueError:
       return []
 
+  # nlargest keeps the stable ordering of sorted(..., reverse=True)[:k]
+  # without sorting every candidate; ts grows with the index, so the
+  # survivors are put back in path order with a plain sort.
   peak_indices = sorted(
-    peak_indices, key=lambda i: elevations[i], reverse=True
-  )[:LOS_PEAKS_MAX]
-  peak_indices = sorted(peak_indices, key=lambda i: points[i][2])
+    heapq.nlargest(LOS_PEAKS_MAX, peak_indices, key=elevations.__getitem__)
+  )
 
   peaks = []
   for i, idx in enumerate(peak_indices, start=1):
-    t = points[idx][2]
+    t = samples.ts[idx]
     peaks.append(
       {
         "index": i,
-        "lat": round(points[idx][0], 6),
-        "lon": round(points[idx][1], 6),
+        "lat": round(samples.lats[idx], 6),
+        "lon": round(samples.lons[idx], 6),
         "elevation_m": round(float(elevations[idx]), 2),
         "distance_m": round(distance_m * t, 2),
       }
@@ -1,10 +1,20 @@
-from collections import deque
-from dataclasses import dataclass
-from typing import Any, Deque, Dict, List, Optional, Set
+import threading
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
 
 import config
 
 
+def _coords_are_zero(lat: Any, lon: Any) -> bool:
+  try:
+    lat_val = float(lat)
+    lon_val = float(lon)
+  except (TypeError, ValueError):
+    return False
+  return abs(lat_val) < 1e-6 and abs(lon_val) < 1e-6
+
+
 @dataclass
 class DeviceState:
   device_id: str
@@ -18,6 +28,21 @@ class DeviceState:
   name: Optional[str] = None
   role: Optional[str] = None
   raw_topic: Optional[str] = None
+  # Derived, not serialized. lat/lon are never reassigned (updates build a
+  # new DeviceState), so the zero-coords test runs once here.
+  has_coords: bool = field(init=False, repr=False, compare=False)
+
+  def __post_init__(self) -> None:
+    self.has_coords = not _coords_are_zero(self.lat, self.lon)
+
+
+@dataclass(slots=True)
+class MessageOrigin:
+  """Per-message-hash origin bookkeeping; slotted since one exists per hash."""
+  ts: float
+  origin_id: Optional[str] = None
+  first_rx: Optional[str] = None
+  receivers: Optional[Set[str]] = None  # created on the first rx
 
 
 stats = {
@@ -28,6 +53,7 @@ stats = {
   "last_rx_topic": None,
   "last_parsed_ts": None,
   "last_parsed_topic": None,
+  "queue_dropped": 0,
 }
 result_counts: Dict[str, int] = {}
 seen_devices: Dict[str, float] = {}
@@ -39,20 +65,44 @@ debug_last: Deque[Dict[str, Any]] = deque(maxlen=config.DEBUG_LAST_MAX)
 status_last: Deque[Dict[str, Any]] = deque(maxlen=config.DEBUG_STATUS_MAX)
 
 devices: Dict[str, DeviceState] = {}
-trails: Dict[str, list] = {}
+trails: Dict[str, Deque[tuple]] = {}
 routes: Dict[str, Dict[str, Any]] = {}
 heat_events: List[Dict[str, float]] = []
+# Min-heaps of (expires_at, id) for the reaper. Entries are not removed when a
+# device/route changes; stale ones are skipped or re-pushed once they surface.
+device_expiry_heap: List[Tuple[float, str]] = []
+# The one live device_expiry_heap stamp per device; popped entries whose stamp
+# differs are superseded and dropped, so the heap stays one entry per device.
+device_expiry_at: Dict[str, float] = {}
+route_expiry_heap: List[Tuple[float, str]] = []
 route_history_segments: Deque[Dict[str, Any]] = deque()
-route_history_edges: Dict[str, Dict[str, Any]] = {}
+# Keyed by the normalized ((lat, lon), (lat, lon)) endpoint pair; the string
+# id sent to clients lives on the edge itself.
+route_history_edges: Dict[Tuple[Tuple[float, float], Tuple[float, float]],
+                          Dict[str, Any]] = {}
 route_history_compact = False
 route_history_last_compact = 0.0
 node_hash_to_device: Dict[str, str] = {}
 node_hash_collisions: Set[str] = set()
 node_hash_candidates: Dict[str, List[str]] = {}
-elevation_cache: Dict[str, tuple] = {}
+# Set when devices are added (removals update the maps in place); the
+# broadcaster rebuilds the maps above once per batch (or just before resolving
+# a route) instead of per event.
+node_hash_map_dirty = False
+# LRU order (hits move to the end), capped at ELEVATION_CACHE_MAX by los.py.
+elevation_cache: "OrderedDict[str, tuple]" = OrderedDict()
 device_names: Dict[str, str] = {}
-message_origins: Dict[str, Dict[str, Any]] = {}
+# Kept in recency order (touched entries move to the end) so the oldest can be
+# dropped once MESSAGE_ORIGIN_MAX is reached. Written from paho's thread and
+# expired from the event loop, so both sides hold message_origins_lock.
+message_origins: "OrderedDict[str, MessageOrigin]" = OrderedDict()
+message_origins_lock = threading.Lock()
 device_roles: Dict[str, str] = {}
 device_role_sources: Dict[str, str] = {}
 neighbor_edges: Dict[str, Dict[str, Dict[str, Any]]] = {}
-state_dirty = False
+# Sections of the state file ("devices", "trails", "names") changed since the
+# last save; the saver only re-encodes these.
+state_dirty: Set[str] = set()
+# Bumped from the event loop whenever client-visible state may have changed;
+# app.py uses it to reuse the serialized snapshot between changes.
+snapshot_version = 0
@@ -3921,10 +3921,14 @@ async function initialSnapshot() {
   }
 }
 
+// Large frames (the initial snapshot) arrive as binary UTF-8 JSON.
+const wsTextDecoder = new TextDecoder();
+
 function connectWS() {
   const proto = location.protocol === 'https:' ? 'wss' : 'ws';
   const wsSuffix = (prodMode && apiToken) ? `?token=${encodeURIComponent(apiToken)}` : '';
   const ws = new WebSocket(`${proto}://${location.host}/ws${wsSuffix}`);
+  ws.binaryType = 'arraybuffer';
 
   ws.onopen = () => console.log("ws connected");
   ws.onclose = () => {
@@ -3933,7 +3937,8 @@ function connectWS() {
   };
 
   ws.onmessage = (ev) => {
-    const msg = JSON.parse(ev.data);
+    const raw = typeof ev.data === 'string' ? ev.data : wsTextDecoder.decode(ev.data);
+    const msg = JSON.parse(raw);
 
     if (msg.type === "snapshot") {
       // same shape as /snapshot
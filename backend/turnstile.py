@@ -1,7 +1,8 @@
 import time
+import heapq
 import secrets
 import json
-from typing import Dict, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 from dataclasses import dataclass
 
 import httpx
@@ -35,6 +36,29 @@ class TurnstileVerifier:
     self.api_url = api_url
     self.token_ttl_seconds = token_ttl_seconds
     self.issued_tokens: Dict[str, TokenData] = {}
+    # (expires_at, token) min-heap so cleanup only touches expired tokens.
+    self._expiry_heap: List[Tuple[float, str]] = []
+    self._client: Optional[httpx.AsyncClient] = None
+
+  def _get_client(self) -> httpx.AsyncClient:
+    # Created lazily (inside the running loop) and reused so verifications
+    # share keep-alive connections instead of a TLS handshake each.
+    if self._client is None:
+      self._client = httpx.AsyncClient(
+        timeout=10.0,
+        limits=httpx.Limits(max_keepalive_connections=10),
+      )
+    return self._client
+
+  async def aclose(self) -> None:
+    """Close the pooled HTTP client, if one was opened."""
+    if self._client is None:
+      return
+    try:
+      await self._client.aclose()
+    except Exception:
+      pass
+    self._client = None
 
   async def verify_turnstile_token(
     self, token: str, remote_ip: Optional[str] = None
@@ -49,16 +73,14 @@ class TurnstileVerifier:
       Tuple of (success: bool, error: Optional[str])
     """
     try:
-      async with httpx.AsyncClient() as client:
-        response = await client.post(
-          self.api_url,
-          data={
-            "secret": self.secret_key,
-            "response": token,
-          },
-          timeout=10.0,
-        )
-        result = response.json()
+      response = await self._get_client().post(
+        self.api_url,
+        data={
+          "secret": self.secret_key,
+          "response": token,
+        },
+      )
+      result = response.json()
 
       if result.get("success"):
         return True, None
@@ -77,11 +99,16 @@ class TurnstileVerifier:
     """
     token = secrets.token_urlsafe(32)
     now = time.time()
+    expires_at = now + self.token_ttl_seconds
     self.issued_tokens[token] = TokenData(
       token=token,
       created_at=now,
-      expires_at=now + self.token_ttl_seconds,
+      expires_at=expires_at,
     )
+    heapq.heappush(self._expiry_heap, (expires_at, token))
+    # Cheap now that cleanup is heap-driven; keeps tokens that are never
+    # presented again from piling up.
+    self.cleanup_expired_tokens()
     return token
 
   def verify_auth_token(self, token: str) -> bool:
@@ -106,6 +133,9 @@ class TurnstileVerifier:
   def cleanup_expired_tokens(self) -> None:
     """Remove expired tokens from storage."""
     now = time.time()
-    expired = [t for t, d in self.issued_tokens.items() if d.expires_at < now]
-    for token in expired:
-      del self.issued_tokens[token]
+    heap = self._expiry_heap
+    while heap and heap[0][0] < now:
+      _, token = heapq.heappop(heap)
+      token_data = self.issued_tokens.get(token)
+      if token_data and token_data.expires_at < now:
+        del self.issued_tokens[token]